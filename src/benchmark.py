@@ -0,0 +1,129 @@
+import time
+import numpy as np
+from utils import argmanager
+
+
+def time_call(func, num_repeats):
+    times = []
+    for i in range(num_repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return np.median(times) * 1000
+
+def random_codes(batch_size, input_len, random_seed):
+    rng = np.random.RandomState(random_seed)
+    bases = np.frombuffer(b"ACGTacgtN", dtype=np.uint8)
+    return bases[rng.choice(len(bases), size=(batch_size, input_len),
+                            p=[0.24, 0.24, 0.24, 0.24, 0.01, 0.01, 0.005, 0.005, 0.01])]
+
+def benchmark_one_hot(args):
+    from utils import one_hot
+
+    codes = random_codes(args.batch_size, args.input_len, args.random_seed)
+    seqs = [x.tobytes().decode("ascii") for x in codes]
+    out = np.empty((args.batch_size, args.input_len, 4), dtype=np.int8)
+
+    assert np.array_equal(one_hot.dna_to_one_hot(seqs), one_hot.dna_to_one_hot_lut(codes, out=out))
+    assert np.array_equal(one_hot.dna_to_one_hot(seqs), one_hot.dna_to_one_hot_lut(seqs, out=out))
+
+    results = [("dna_to_one_hot (strings)", time_call(lambda: one_hot.dna_to_one_hot(seqs), args.num_repeats)),
+               ("dna_to_one_hot_lut (strings, reused buffer)", time_call(lambda: one_hot.dna_to_one_hot_lut(seqs, out=out), args.num_repeats)),
+               ("dna_to_one_hot_lut (uint8 codes, reused buffer)", time_call(lambda: one_hot.dna_to_one_hot_lut(codes, out=out), args.num_repeats))]
+    return results
+
+def benchmark_jsd(args):
+    from scipy.spatial.distance import jensenshannon
+    from utils.helpers import softmax, jensenshannon_distance
+
+    # profile logits of allele pairs with effects ranging from none to strong
+    rng = np.random.RandomState(args.random_seed)
+    allele1_logits = rng.normal(scale=2, size=(args.batch_size, args.profile_len)).astype(np.float32)
+    effect_sizes = np.logspace(-6, 1, args.batch_size, dtype=np.float32)[:, None]
+    allele2_logits = allele1_logits + effect_sizes * rng.normal(size=allele1_logits.shape).astype(np.float32)
+
+    def scipy_jsd():
+        return np.array([jensenshannon(x, y, base=2.0)
+                         for x,y in zip(softmax(allele2_logits.astype(np.float64)),
+                                        softmax(allele1_logits.astype(np.float64)))])
+
+    results = [("scipy jensenshannon (per variant, float64 softmax)", time_call(scipy_jsd, args.num_repeats)),
+               ("jensenshannon_distance (batched, float32 log space)", time_call(lambda: jensenshannon_distance(allele2_logits, allele1_logits), args.num_repeats))]
+    return results
+
+def benchmark_shuffle(args):
+    from deeplift.dinuc_shuffle import dinuc_shuffle
+    from utils.dinuc_shuffle import dinuc_shuffle_codes
+
+    codes = random_codes(args.batch_size, args.input_len, args.random_seed)
+    seeds = np.random.RandomState(args.random_seed).permutation(args.batch_size * 10)[:args.batch_size]
+
+    def deeplift_shuffle():
+        return np.array([np.frombuffer(dinuc_shuffle(x.tobytes().decode("ascii"), rng=np.random.RandomState(seed)).encode("ascii"), dtype=np.uint8)
+                         for x, seed in zip(codes, seeds)])
+
+    assert np.array_equal(deeplift_shuffle(), dinuc_shuffle_codes(codes, seeds))
+
+    results = [("deeplift dinuc_shuffle (per sequence, strings)", time_call(deeplift_shuffle, args.num_repeats)),
+               ("dinuc_shuffle_codes (batched, uint8 codes)", time_call(lambda: dinuc_shuffle_codes(codes, seeds), args.num_repeats))]
+    return results
+
+def benchmark_inference(args):
+    from utils.helpers import load_model_wrapper, get_lite_bias_inputs
+    from utils.inference_engine import InferenceEngine
+    from utils import one_hot
+
+    if args.model is None:
+        raise ValueError("The inference benchmark needs --model")
+    model = load_model_wrapper(args.model)
+    input_len = model.input_shape[0][1] if args.lite else model.input_shape[1]
+    # a full batch and a shorter last batch, which model.predict retraces for
+    seqs = one_hot.dna_to_one_hot_lut(random_codes(args.batch_size, input_len, args.random_seed))
+    last_seqs = seqs[:args.batch_size // 3 + 1]
+
+    def keras_predict():
+        for x in [seqs, last_seqs]:
+            if args.lite:
+                model.predict([x] + get_lite_bias_inputs(model, len(x)), verbose=False)
+            else:
+                model.predict(x, verbose=False)
+
+    engine = InferenceEngine(model, args.batch_size, lite=args.lite)
+    xla_engine = InferenceEngine(model, args.batch_size, lite=args.lite, jit_compile=True)
+    if args.lite:
+        keras_preds = model.predict([seqs] + get_lite_bias_inputs(model, len(seqs)), verbose=False)
+    else:
+        keras_preds = model.predict(seqs, verbose=False)
+    for preds in [engine.predict(seqs), xla_engine.predict(seqs)]:
+        np.testing.assert_allclose(preds[0], keras_preds[0], rtol=1e-3, atol=1e-4)
+        np.testing.assert_allclose(preds[1], keras_preds[1], rtol=1e-3, atol=1e-4)
+
+    results = [("model.predict (full and short batch)", time_call(keras_predict, args.num_repeats)),
+               ("InferenceEngine (full and short batch)", time_call(lambda: [engine.predict(x) for x in [seqs, last_seqs]], args.num_repeats)),
+               ("InferenceEngine, XLA (full and short batch)", time_call(lambda: [xla_engine.predict(x) for x in [seqs, last_seqs]], args.num_repeats))]
+    return results
+
+BENCHMARKS = {'one_hot': benchmark_one_hot,
+              'jsd': benchmark_jsd,
+              'shuffle': benchmark_shuffle,
+              'inference': benchmark_inference}
+
+
+def main():
+    args = argmanager.fetch_benchmark_args()
+
+    for name in args.benchmark:
+        print()
+        print("Benchmark:", name, "| batch size:", args.batch_size, "| input length:", args.input_len, "| profile length:", args.profile_len)
+        results = BENCHMARKS[name](args)
+        baseline = results[0][1]
+        for label, ms in results:
+            print("%-50s %10.2f ms/batch %8.1fx" % (label, ms, baseline / ms))
+
+    print()
+    print("DONE")
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+from utils import argmanager
+from utils.genome import write_genome_cache
+
+
+def main():
+    args = argmanager.fetch_genome_cache_args()
+    print(args)
+
+    genomes = [(args.genome, args.out_dir)]
+    if args.peak_genome:
+        if args.peak_out_dir == None:
+            raise ValueError("--peak_out_dir is required with --peak_genome")
+        genomes.append((args.peak_genome, args.peak_out_dir))
+
+    for genome_fasta, out_dir in genomes:
+        print()
+        print("Writing genome cache for", genome_fasta, "to", out_dir)
+        print()
+        index = write_genome_cache(genome_fasta, out_dir)
+        print("Genome cache chromosomes:", len(index))
+
+    print("DONE")
+    print()
+
+
+if __name__ == "__main__":
+    main()
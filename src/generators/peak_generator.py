@@ -2,8 +2,8 @@ from tensorflow.keras.utils import Sequence
 import pandas as pd
 import numpy as np
 import math
-import pyfaidx
 from utils import one_hot
+from utils.genome import load_genome
 
 
 class PeakGenerator(Sequence):
@@ -12,33 +12,46 @@ class PeakGenerator(Sequence):
                  input_len,
                  genome_fasta,
                  batch_size=512,
-                 debug_mode=False):
+                 debug_mode=False,
+                 num_buffers=0):
 
         self.peaks = peaks
         self.num_peaks = self.peaks.shape[0]
         self.input_len = input_len
-        self.genome = pyfaidx.Fasta(genome_fasta)
+        self.genome = load_genome(genome_fasta)
         self.debug_mode = debug_mode
         self.flank_size = self.input_len // 2
         self.batch_size = batch_size
+        # batches are one-hot encoded into num_buffers preallocated arrays
+        # used in turn, so a batch stays valid for the next num_buffers - 1
+        # batches; with 0 buffers every batch gets a new array
+        self.num_buffers = num_buffers
+        self.seq_buffers = [np.empty((self.batch_size, self.flank_size * 2, 4), dtype=np.int8)
+                            for i in range(self.num_buffers)]
+        self.num_batches_encoded = 0
 
     def __get_seq__(self, chrom, start, summit):
         chrom = str(chrom)
         start = int(start)
         summit = int(start) + int(summit)
-        flank_start = int(summit - self.flank_size)
+        ### 1 - indexed, end-inclusive window [summit - flank_size, summit + flank_size - 1]
+        flank_start = int(summit - self.flank_size) - 1
         flank_end = int(summit + (self.flank_size - 1))
-        flank = str(self.genome.get_seq(chrom, flank_start, flank_end))
-        return flank
+        return self.genome.fetch(chrom, flank_start, flank_end)
 
     def __getitem__(self, idx):
         cur_entries = self.peaks.iloc[idx*self.batch_size:min([self.num_peaks,(idx+1)*self.batch_size])]
         peak_ids = cur_entries['chr'] + ':' + cur_entries['start'].astype(str) + '-' + cur_entries['end'].astype(str)
 
-        seqs = [self.__get_seq__(x, y, z) for x,y,z in
-                zip(cur_entries.chr, cur_entries.start, cur_entries.summit)]
+        seqs = np.stack([self.__get_seq__(x, y, z) for x,y,z in
+                         zip(cur_entries.chr, cur_entries.start, cur_entries.summit)])
 
-        return peak_ids, one_hot.dna_to_one_hot(seqs)
+        if self.num_buffers > 0:
+            buffer_idx = self.num_batches_encoded % self.num_buffers
+            self.num_batches_encoded += 1
+            return peak_ids, one_hot.dna_to_one_hot_lut(seqs, out=self.seq_buffers[buffer_idx][:len(seqs)])
+        else:
+            return peak_ids, one_hot.dna_to_one_hot_lut(seqs)
     
     def __len__(self):
         return math.ceil(self.num_peaks/self.batch_size)
@@ -0,0 +1,77 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque
+import multiprocessing
+import threading
+
+# each worker thread or process keeps its own generator, and with it its own
+# genome handle and one-hot buffers
+worker_state = threading.local()
+
+
+def init_worker(generator_class, generator_kwargs):
+    worker_state.generator = generator_class(**generator_kwargs)
+
+def fetch_batch(idx):
+    return worker_state.generator[idx]
+
+
+class BatchPrefetcher:
+    # yields the batches of a generator in order while worker threads (or processes), each with its own generator,
+    # build up to queue_depth batches ahead; num_workers=0 builds them in the calling thread
+    def __init__(self,
+                 generator_class,
+                 generator_kwargs,
+                 num_workers=0,
+                 queue_depth=2,
+                 use_processes=False,
+                 batch_indices=None):
+
+        self.generator_class = generator_class
+        self.num_workers = num_workers
+        self.queue_depth = max(queue_depth, 1)
+        self.use_processes = use_processes
+        self.generator = generator_class(**generator_kwargs)
+        if batch_indices is None:
+            batch_indices = range(len(self.generator))
+        self.batch_indices = list(batch_indices)
+        self.worker_kwargs = dict(generator_kwargs)
+        if not self.use_processes and self.worker_kwargs.get('num_buffers', 0) > 0:
+            # a thread's buffers may be read by the consumer while the thread
+            # builds later batches: keep one buffer per batch that can be
+            # pending or in use at the same time
+            self.worker_kwargs['num_buffers'] = self.queue_depth + 1
+
+    def __len__(self):
+        return len(self.batch_indices)
+
+    def __iter__(self):
+        num_batches = len(self.batch_indices)
+        if self.num_workers == 0:
+            for idx in self.batch_indices:
+                yield self.generator[idx]
+            return
+
+        if self.use_processes:
+            executor = ProcessPoolExecutor(max_workers=self.num_workers,
+                                           mp_context=multiprocessing.get_context('spawn'),
+                                           initializer=init_worker,
+                                           initargs=(self.generator_class, self.worker_kwargs))
+        else:
+            executor = ThreadPoolExecutor(max_workers=self.num_workers,
+                                          initializer=init_worker,
+                                          initargs=(self.generator_class, self.worker_kwargs))
+        try:
+            pending = deque()
+            next_idx = 0
+            while next_idx < num_batches and len(pending) < self.queue_depth:
+                pending.append(executor.submit(fetch_batch, self.batch_indices[next_idx]))
+                next_idx += 1
+
+            while len(pending) > 0:
+                batch = pending.popleft().result()
+                if next_idx < num_batches:
+                    pending.append(executor.submit(fetch_batch, self.batch_indices[next_idx]))
+                    next_idx += 1
+                yield batch
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -2,93 +2,158 @@ from tensorflow.keras.utils import Sequence
 import pandas as pd
 import numpy as np
 import math
-import pyfaidx
 from utils import one_hot
+from utils.genome import load_genome
 from deeplift.dinuc_shuffle import dinuc_shuffle
+from utils.dinuc_shuffle import dinuc_shuffle_codes
+
+# maps ASCII codes to their upper-case equivalents
+UPPER_CASE = np.arange(256, dtype=np.uint8)
+UPPER_CASE[ord('a'):ord('z') + 1] -= 32
 
 
 class VariantGenerator(Sequence):
+    # variants closer than this many bases share a single genome read
+    max_read_gap = 100000
+
     def __init__(self,
                  variants_table,
                  input_len,
                  genome_fasta,
                  batch_size=512,
                  debug_mode=False,
-                 shuf=False):
+                 shuf=False,
+                 num_buffers=0,
+                 shuffle_impl='batched'):
 
         self.variants_table = variants_table
         self.num_variants = self.variants_table.shape[0]
         self.input_len = input_len
-        self.genome = pyfaidx.Fasta(genome_fasta)
+        self.genome = load_genome(genome_fasta)
         self.debug_mode = debug_mode
         self.flank_size = self.input_len // 2
         self.shuf = shuf
+        # 'batched' shuffles a whole batch at once with the same results as
+        # deeplift's per-sequence 'deeplift' dinuc_shuffle
+        assert shuffle_impl in ['batched', 'deeplift']
+        self.shuffle_impl = shuffle_impl
         self.batch_size = batch_size
+        # batches are one-hot encoded into num_buffers preallocated arrays
+        # used in turn, so a batch stays valid for the next num_buffers - 1
+        # batches; with 0 buffers every batch gets new arrays
+        self.num_buffers = num_buffers
+        self.allele1_buffers = [np.empty((self.batch_size, self.flank_size * 2, 4), dtype=np.int8)
+                                for i in range(self.num_buffers)]
+        self.allele2_buffers = [np.empty((self.batch_size, self.flank_size * 2, 4), dtype=np.int8)
+                                for i in range(self.num_buffers)]
+        self.num_batches_encoded = 0
+
+    def __get_batch_allele_seqs__(self, chroms, positions, allele1s, allele2s, seeds=None):
+        # allele1 and allele2 windows of a batch as N x input_len uint8 ASCII arrays in input order, with one genome read per run of nearby variants
+        num_variants = len(positions)
+        seq_len = self.flank_size * 2
+        chroms = np.array([str(x) for x in chroms])
+        ### 1 - indexed position
+        starts = np.asarray(positions, dtype=np.int64) - 1 - self.flank_size
+
+        allele1s = ["" if str(x) == "-" else str(x) for x in allele1s]
+        allele2s = ["" if str(x) == "-" else str(x) for x in allele2s]
+        allele1_lens = np.array([len(x) for x in allele1s], dtype=np.int64)
+        allele2_lens = np.array([len(x) for x in allele2s], dtype=np.int64)
+        assert np.all(allele1_lens <= self.flank_size) and np.all(allele2_lens <= self.flank_size)
+
+        # deletions need mismatch_length extra bases on the right of the flank
+        mismatch_lens = allele1_lens - allele2_lens
+        flank_lens = seq_len + np.maximum(mismatch_lens, 0)
+        flanks = np.zeros((num_variants, flank_lens.max()), dtype=np.uint8)
 
-    def __get_allele_seq__(self, chrom, pos, allele1, allele2, seed=-1):
-        chrom = str(chrom)
-        pos = int(pos)
-        allele1 = str(allele1)
-        allele2 = str(allele2)
-        
-        if allele1 == "-":
-            allele1 = ""
-        if allele2 == "-":
-            allele2 = ""
-        ### 1 - indexed position 
-        pos = pos - 1
-        
-        if len(allele1) == len(allele2):
-            flank  = str(self.genome[chrom][pos-self.flank_size:pos+self.flank_size])
-            if self.shuf:
-                assert seed != -1
-                flank = dinuc_shuffle(flank, rng=np.random.RandomState(seed))
-            allele1_seq = flank[:self.flank_size] + allele1 + flank[self.flank_size+len(allele1):]
-            allele2_seq = flank[:self.flank_size] + allele2 + flank[self.flank_size+len(allele2):]
+        order = np.lexsort((starts, chroms))
+        run_start = 0
+        while run_start < num_variants:
+            chrom = chroms[order[run_start]]
+            run_end = run_start + 1
+            span_end = starts[order[run_start]] + flank_lens[order[run_start]]
+            while run_end < num_variants and chroms[order[run_end]] == chrom \
+                    and starts[order[run_end]] - span_end <= self.max_read_gap:
+                span_end = max(span_end, starts[order[run_end]] + flank_lens[order[run_end]])
+                run_end += 1
+
+            rows = order[run_start:run_end]
+            span_start = starts[rows[0]]
+            assert span_start >= 0
+            buffer = self.genome.fetch(chrom, span_start, span_end)
+            assert np.all(starts[rows] + flank_lens[rows] <= span_start + len(buffer))
+            buffer_idx = (starts[rows] - span_start)[:, None] + np.arange(flanks.shape[1])[None, :]
+            flanks[rows] = buffer[np.minimum(buffer_idx, len(buffer) - 1)]
+            run_start = run_end
 
         ### handle INDELS (allele1 must be the reference allele)
-        else:
-            ### hg19 has lower case
-            assert len(allele1) != len(allele2)
-            assert self.genome[chrom][pos:pos+len(allele1)].seq.upper() == allele1
-            mismatch_length = len(allele1) - len(allele2)
-            if mismatch_length > 0:
-                flank = str(self.genome[chrom][pos-self.flank_size:pos+self.flank_size+mismatch_length])
-            else:
-                flank = str(self.genome[chrom][pos-self.flank_size:pos+self.flank_size])
+        ### hg19 has lower case
+        indel_rows = np.where(allele1_lens != allele2_lens)[0]
+        if len(indel_rows) > 0:
+            ref_rows, ref_cols, ref_bases = self.__allele_positions__([allele1s[i] for i in indel_rows],
+                                                                      allele1_lens[indel_rows])
+            assert np.array_equal(UPPER_CASE[flanks[indel_rows[ref_rows], ref_cols]], ref_bases)
 
-            if self.shuf:
-                assert seed != -1
-                flank = dinuc_shuffle(flank, rng=np.random.RandomState(seed))
+        if self.shuf:
+            assert seeds is not None
+            if self.shuffle_impl == 'batched':
+                # flanks of the same length are shuffled together
+                for flank_len in np.unique(flank_lens):
+                    rows = np.where(flank_lens == flank_len)[0]
+                    flanks[rows, :flank_len] = dinuc_shuffle_codes(flanks[rows, :flank_len], seeds[rows])
+            else:
+                for i in range(num_variants):
+                    flank = flanks[i, :flank_lens[i]].tobytes().decode("ascii")
+                    flank = dinuc_shuffle(flank, rng=np.random.RandomState(seeds[i]))
+                    flanks[i, :flank_lens[i]] = np.frombuffer(flank.encode("ascii"), dtype=np.uint8)
 
-            left_flank=flank[:self.flank_size]
+        # bases right of an allele are read from the flank shifted by the
+        # difference between the reference and this allele's length
+        seq_cols = np.arange(seq_len)[None, :]
+        batch_rows = np.arange(num_variants)[:, None]
+        allele_seqs = []
+        for alleles, allele_lens in [(allele1s, allele1_lens), (allele2s, allele2_lens)]:
+            shift = np.where(seq_cols >= self.flank_size + allele_lens[:, None],
+                             (allele1_lens - allele_lens)[:, None], 0)
+            seqs = flanks[batch_rows, seq_cols + shift]
+            allele_rows, allele_cols, allele_bases = self.__allele_positions__(alleles, allele_lens)
+            seqs[allele_rows, allele_cols] = allele_bases
+            allele_seqs.append(seqs)
 
-            allele1_right_flank = flank[self.flank_size+len(allele1):self.flank_size*2]
-            allele2_right_flank = flank[self.flank_size+len(allele1):self.flank_size*2+mismatch_length]
-            
-            allele1_seq = left_flank + allele1 + allele1_right_flank
-            allele2_seq = left_flank + allele2 + allele2_right_flank
+        return allele_seqs[0], allele_seqs[1]
 
-        assert len(allele1_seq) == self.flank_size * 2
-        assert len(allele2_seq) == self.flank_size * 2
-        return allele1_seq, allele2_seq
+    def __allele_positions__(self, alleles, allele_lens):
+        # row indices, window columns and ASCII codes that write each allele into its window at the variant position
+        rows = np.repeat(np.arange(len(alleles)), allele_lens)
+        offsets = np.arange(len(rows)) - np.repeat(np.cumsum(allele_lens) - allele_lens, allele_lens)
+        bases = np.frombuffer("".join(alleles).encode("ascii"), dtype=np.uint8)
+        return rows, self.flank_size + offsets, bases
 
     def __getitem__(self, idx):
         cur_entries = self.variants_table.iloc[idx*self.batch_size:min([self.num_variants,(idx+1)*self.batch_size])]
         variant_ids = cur_entries['variant_id'].tolist()
 
         if self.shuf:
-            allele1_seqs, allele2_seqs = zip(*[self.__get_allele_seq__(v, w, x, y, z) for v,w,x,y,z in
-                                             zip(cur_entries.chr, cur_entries.pos,
-                                                 cur_entries.allele1, cur_entries.allele2, cur_entries.random_seed)])
+            seeds = cur_entries['random_seed'].to_numpy()
         else:
-            allele1_seqs, allele2_seqs = zip(*[self.__get_allele_seq__(w, x, y, z) for w,x,y,z in
-                                             zip(cur_entries.chr, cur_entries.pos, cur_entries.allele1, cur_entries.allele2)])
+            seeds = None
+        allele1_seqs, allele2_seqs = self.__get_batch_allele_seqs__(cur_entries['chr'].tolist(),
+                                                                    cur_entries['pos'].to_numpy(),
+                                                                    cur_entries['allele1'].tolist(),
+                                                                    cur_entries['allele2'].tolist(),
+                                                                    seeds)
 
         if self.debug_mode:
-            return variant_ids, list(allele1_seqs),list(allele2_seqs)
+            return variant_ids, [x.tobytes().decode("ascii") for x in allele1_seqs], \
+                   [x.tobytes().decode("ascii") for x in allele2_seqs]
+        elif self.num_buffers > 0:
+            buffer_idx = self.num_batches_encoded % self.num_buffers
+            self.num_batches_encoded += 1
+            return variant_ids, one_hot.dna_to_one_hot_lut(allele1_seqs, out=self.allele1_buffers[buffer_idx][:len(variant_ids)]), \
+                   one_hot.dna_to_one_hot_lut(allele2_seqs, out=self.allele2_buffers[buffer_idx][:len(variant_ids)])
         else:
-            return variant_ids, one_hot.dna_to_one_hot(list(allele1_seqs)), one_hot.dna_to_one_hot(list(allele2_seqs))
+            return variant_ids, one_hot.dna_to_one_hot_lut(allele1_seqs), one_hot.dna_to_one_hot_lut(allele2_seqs)
     
     def __len__(self):
         return math.ceil(self.num_variants/self.batch_size)
@@ -3,9 +3,9 @@ import argparse
 
 def update_scoring_args(parser):
     parser.add_argument("-l", "--list", type=str, required=True, help="a TSV file containing a list of variants to score")
-    parser.add_argument("-g", "--genome", type=str, required=True, help="Genome fasta")
-    parser.add_argument("-pg", "--peak_genome", type=str, help="Genome fasta for peaks")
-    parser.add_argument("-m", "--model", type=str, required=True, help="ChromBPNet model to use for variant scoring")
+    parser.add_argument("-g", "--genome", type=str, required=True, help="Genome fasta or genome cache directory")
+    parser.add_argument("-pg", "--peak_genome", type=str, help="Genome fasta or genome cache directory for peaks")
+    parser.add_argument("-m", "--model", type=str, nargs='+', required=True, help="ChromBPNet model(s) to use for variant scoring; several models (e.g. folds or cell types) are scored in one pass over the variants")
     parser.add_argument("-o", "--out_prefix", type=str, required=True, help="Path to storing snp effect score predictions from the script, directory should already exist")
     parser.add_argument("-s", "--chrom_sizes", type=str, required=True, help="Path to TSV file with chromosome sizes")
     parser.add_argument("-ps", "--peak_chrom_sizes", type=str, help="Path to TSV file with chromosome sizes for peak genome")
@@ -24,7 +24,33 @@ def update_scoring_args(parser):
     parser.add_argument("-nc", "--num_chunks", type=int, default=10, help="Number of chunks to divide SNP file into")
     parser.add_argument("-fo", "--forward_only", action='store_true', help="Run variant scoring only on forward sequence")
     parser.add_argument("-st", "--shap_type",  nargs='+', default=["counts"])
-    parser.add_argument("-sh", "--shuffled_scores", type=str, help="Pre-computed shuffled scores")
+    parser.add_argument("-sh", "--shuffled_scores", type=str, nargs='+', help="Pre-computed shuffled scores, one file per model")
+    parser.add_argument("-nb", "--null_bank", type=str, nargs='+', help="Null bank directories, one per model. Default is <model>.null_bank next to each model")
+    parser.add_argument("--build_null_bank", action='store_true', help="Build (or rebuild) the null bank of each model from the shuffled variants of this run")
+    parser.add_argument("--null_bank_size", type=int, help="Number of shuffled variants in a newly built null bank. Default is the size set by --total_shuf or --num_shuf")
+    parser.add_argument("--null_memmap", action='store_true', help="Memory-map the sorted shuffled scores from <out_prefix>.null.<score>.npy files instead of keeping them in memory")
+    parser.add_argument("--no_null_bank", action='store_true', help="Ignore existing null banks and score the shuffled variants of this run")
+    parser.add_argument("-pw", "--prefetch_workers", type=int, default=0, help="Number of workers building input batches ahead of the model. 0 builds batches in the main thread")
+    parser.add_argument("-qd", "--queue_depth", type=int, default=2, help="Maximum number of input batches built ahead of the model")
+    parser.add_argument("--prefetch_processes", action='store_true', help="Use processes instead of threads for the prefetch workers")
+    parser.add_argument("-fi", "--fused_inference", action='store_true', help="Predict both alleles and both strands of a batch with a single model call")
+    parser.add_argument("-ci", "--compiled_inference", action='store_true', help="Predict through a tf.function compiled once at load for a fixed, padded batch shape instead of model.predict")
+    parser.add_argument("--xla", action='store_true', help="Compile the --compiled_inference graph with XLA")
+    parser.add_argument("-hc", "--hdf5_compression", type=str, choices=['gzip-9', 'gzip-1', 'lz4', 'zstd', 'none'], default='gzip-9', help="Codec of the hdf5 predictions; lz4 and zstd need hdf5plugin")
+    parser.add_argument("--profile_window", type=int, default=None, help="Only save the central W bp of the predicted profiles to hdf5, 0 to save none; the full profiles are saved by default")
+    parser.add_argument("--profile_summary", action='store_true', help="Also save per-variant summaries of the full predicted profiles to hdf5")
+    parser.add_argument("-pd", "--profile_dtype", type=str, choices=['float16', 'float32'], default='float32', help="Floating point type of the predicted profiles kept in memory and saved to hdf5")
+    parser.add_argument("-sm", "--streaming", action='store_true', help="Score variants batch by batch and append them to the outputs instead of holding all predictions in memory")
+    parser.add_argument("-ig", "--in_graph_scoring", action='store_true', help="With --streaming, compute the counts, logfc and jsd of each batch inside TensorFlow and only move the profiles out of it when they are saved or needed for indels")
+    parser.add_argument("-of", "--output_format", type=str, choices=['tsv', 'parquet', 'feather'], default='tsv', help="Format of the peak, shuffled and variant score tables")
+    parser.add_argument("--per_chrom", action='store_true', help="Score the variants one chromosome at a time, largest first and spread across the workers, and merge them into outputs sorted by position")
+    parser.add_argument("-w", "--workers", type=int, default=0, help="Number of worker processes, each with its own copy of the model, to shard the predictions across")
+    parser.add_argument("--intra_op_threads", type=int, default=0, help="TensorFlow intra-op threads per worker process (0 leaves the TensorFlow default)")
+    parser.add_argument("--inter_op_threads", type=int, default=0, help="TensorFlow inter-op threads per worker process (0 leaves the TensorFlow default)")
+    parser.add_argument("--pin_cpus", action='store_true', help="Pin each worker process to its own subset of the available cores")
+    parser.add_argument("-j", "--journal", action='store_true', help="Journal finished prediction batches with their predictions next to the outputs, so a restarted run resumes at the last finished batch")
+    parser.add_argument("-pc", "--prediction_cache", type=str, help="sqlite file caching predictions across runs, keyed by the model weights, strand mode and input window")
+    parser.add_argument("--prediction_cache_size", type=float, default=10.0, help="Maximum size of the prediction cache in GB, beyond which the least recently used predictions are evicted")
 
 def fetch_scoring_args():
     parser = argparse.ArgumentParser()
@@ -35,7 +61,7 @@ def fetch_scoring_args():
 
 def update_shap_args(parser):
     parser.add_argument("-l", "--list", type=str, required=True, help="a TSV file containing a list of variants to score")
-    parser.add_argument("-g", "--genome", type=str, required=True, help="Genome fasta")
+    parser.add_argument("-g", "--genome", type=str, required=True, help="Genome fasta or genome cache directory")
     parser.add_argument("-m", "--model", type=str, required=True, help="ChromBPNet model to use for variant scoring")
     parser.add_argument("-o", "--out_prefix", type=str, required=True, help="Path to storing snp effect score predictions from the script, directory should already exist")
     parser.add_argument("-s", "--chrom_sizes", type=str, required=True, help="Path to TSV file with chromosome sizes")
@@ -55,9 +81,10 @@ def fetch_shap_args():
 
 def update_variant_summary_args(parser):
     parser.add_argument("-sd", "--score_dir", type=str, required=True, help="Path to directory with variant scores that will be used to generate summary")
-    parser.add_argument("-sl", "--score_list",  nargs='+', required=True, help="Names of variant score files that will be used to generate summary")
+    parser.add_argument("-sl", "--score_list",  nargs='+', required=True, help="Names of variant score files (TSV, parquet or feather) that will be used to generate summary")
     parser.add_argument("-o", "--out_prefix", type=str, required=True, help="Path prefix for storing the summary file with average scores across folds; directory should already exist")
     parser.add_argument("-sc", "--schema", type=str, required=True, choices=['bed', 'plink', 'plink2', 'chrombpnet', 'original'], default='chrombpnet', help="Format for the input variants list")
+    parser.add_argument("-of", "--output_format", type=str, choices=['tsv', 'parquet', 'feather'], default='tsv', help="Format of the output table")
 
 def fetch_variant_summary_args():
     parser = argparse.ArgumentParser()
@@ -67,11 +94,12 @@ def fetch_variant_summary_args():
     return args
 
 def update_variant_annotation_args(parser):
-    parser.add_argument("-l", "--list", type=str, required=True, help="a TSV file containing a list of variants to annotate")
+    parser.add_argument("-l", "--list", type=str, required=True, help="a variant score table (TSV, parquet or feather) containing the variants to annotate")
     parser.add_argument("-o", "--out_prefix", type=str, required=True, help="Path prefix for storing the annotated file; directory should already exist")
     parser.add_argument("-p", "--peaks", type=str, help="Bed file containing peak regions")
     parser.add_argument("-ge", "--genes", type=str, help="Bed file containing gene regions")
     parser.add_argument("-sc", "--schema", type=str, required=True, choices=['bed', 'plink', 'plink2', 'chrombpnet', 'original'], default='chrombpnet', help="Format for the input variants list")
+    parser.add_argument("-of", "--output_format", type=str, choices=['tsv', 'parquet', 'feather'], default='tsv', help="Format of the output table")
 
 def fetch_variant_annotation_args():
     parser = argparse.ArgumentParser()
@@ -79,3 +107,33 @@ def fetch_variant_annotation_args():
     args = parser.parse_args()
     print(args)
     return args
+
+def update_genome_cache_args(parser):
+    parser.add_argument("-g", "--genome", type=str, required=True, help="Genome fasta to convert")
+    parser.add_argument("-o", "--out_dir", type=str, required=True, help="Directory to write the genome cache to")
+    parser.add_argument("-pg", "--peak_genome", type=str, help="Genome fasta for peaks to convert")
+    parser.add_argument("-po", "--peak_out_dir", type=str, help="Directory to write the peak genome cache to")
+
+def fetch_genome_cache_args():
+    parser = argparse.ArgumentParser()
+    update_genome_cache_args(parser)
+    args = parser.parse_args()
+    print(args)
+    return args
+
+def update_benchmark_args(parser):
+    parser.add_argument("-b", "--benchmark", nargs='+', choices=['one_hot', 'jsd', 'shuffle', 'inference'], default=['one_hot', 'jsd', 'shuffle'], help="Benchmarks to run")
+    parser.add_argument("-m", "--model", type=str, help="ChromBPNet model for the inference benchmark")
+    parser.add_argument("-li", "--lite", action='store_true', help="The benchmark model was trained with chrombpnet-lite")
+    parser.add_argument("-bs", "--batch_size", type=int, default=512, help="Number of sequences per benchmark batch")
+    parser.add_argument("-il", "--input_len", type=int, default=2114, help="Length of the benchmark sequences")
+    parser.add_argument("-pl", "--profile_len", type=int, default=1000, help="Length of the benchmark profiles")
+    parser.add_argument("-nr", "--num_repeats", type=int, default=20, help="Number of timed repeats per implementation")
+    parser.add_argument("-r", "--random_seed", type=int, default=1234, help="Random seed for the benchmark sequences")
+
+def fetch_benchmark_args():
+    parser = argparse.ArgumentParser()
+    update_benchmark_args(parser)
+    args = parser.parse_args()
+    print(args)
+    return args
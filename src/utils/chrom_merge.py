@@ -0,0 +1,87 @@
+import numpy as np
+import h5py
+import heapq
+from utils.prediction_writer import PredictionWriter, PROFILE_SUMMARY_DATASETS
+from utils.table_io import get_table_format, iter_score_table_batches, ScoreTableWriter
+
+
+def get_chrom_ranks(chrom_sizes_dict):
+    # chromosomes are merged in the order of the chrom sizes file
+    return {str(x): i for i, x in enumerate(chrom_sizes_dict)}
+
+def get_largest_first_chroms(variants_table, chrom_ranks):
+    # the chromosomes with the most variants are scheduled first, so the
+    # last ones to finish are the shortest; ties are kept in genome order
+    num_variants = variants_table['chr'].value_counts()
+    num_variants = num_variants[num_variants > 0]
+    return sorted(num_variants.index, key=lambda x: (-num_variants[x], chrom_ranks.get(str(x), len(chrom_ranks))))
+
+def merge_chrom_scores(chrom_scores_files, scores_file, chrom_ranks):
+    # streaming k-way merge of position-sorted per-chromosome score files, in chrom_ranks order; returns the number of rows
+    if get_table_format(scores_file) == 'tsv':
+        return merge_chrom_score_lines(chrom_scores_files, scores_file, chrom_ranks)
+    return merge_chrom_score_batches(chrom_scores_files, scores_file, chrom_ranks)
+
+def merge_chrom_score_lines(chrom_scores_files, scores_file, chrom_ranks):
+    chrom_files = [open(x) for x in chrom_scores_files]
+    try:
+        headers = [f.readline() for f in chrom_files]
+        if any(x != headers[0] for x in headers):
+            raise ValueError("Cannot merge score files with different columns")
+        columns = headers[0].rstrip("\n").split("\t")
+        chrom_col, pos_col = columns.index('chr'), columns.index('pos')
+
+        def get_key(line):
+            fields = line.split("\t", max(chrom_col, pos_col) + 1)
+            return (chrom_ranks.get(fields[chrom_col], len(chrom_ranks)), int(fields[pos_col]))
+
+        num_rows = 0
+        with open(scores_file, 'w') as f:
+            f.write(headers[0])
+            for line in heapq.merge(*chrom_files, key=get_key):
+                f.write(line)
+                num_rows += 1
+    finally:
+        for f in chrom_files:
+            f.close()
+    return num_rows
+
+def merge_chrom_score_batches(chrom_scores_files, scores_file, chrom_ranks):
+    # batches of different chromosomes never interleave, so ordering them by their first row is enough
+    def get_key(batch):
+        return (chrom_ranks.get(str(batch['chr'].iloc[0]), len(chrom_ranks)), batch['pos'].iloc[0])
+
+    writer = ScoreTableWriter(scores_file)
+    try:
+        for batch in heapq.merge(*[(x for x in iter_score_table_batches(path) if len(x) > 0) for path in chrom_scores_files],
+                                 key=get_key):
+            writer.write(batch)
+    finally:
+        writer.close()
+    return writer.num_rows
+
+def merge_chrom_predictions(chrom_predictions_files, predictions_file, compression='gzip-9', chunk_size=10000):
+    # concatenates per-chromosome hdf5 predictions, given in merged order, chunk_size rows at a time
+    chrom_files = [h5py.File(x, 'r') for x in chrom_predictions_files]
+    try:
+        # the merged file keeps the profile window and summaries of the per-chromosome files
+        observed = chrom_files[0]['observed']
+        variant_ids = np.char.decode(np.concatenate([x['observed']['variant_id'][()] for x in chrom_files]), 'utf-8')
+        profile_len = int(observed.attrs['profile_len'])
+        profile_start = int(observed.attrs['profile_start'])
+        profile_window = observed['allele1_pred_profiles'].shape[1] if 'allele1_pred_profiles' in observed else 0
+        writer = PredictionWriter(predictions_file, variant_ids, profile_len,
+                                  observed['allele1_pred_profiles'].dtype if profile_window > 0 else np.float32,
+                                  compression, chunk_size,
+                                  profile_window=profile_window, profile_summary=PROFILE_SUMMARY_DATASETS[0][0] in observed)
+        assert writer.profile_start == profile_start
+        merged_start = 0
+        for f in chrom_files:
+            num_rows = len(f['observed']['variant_id'])
+            for start in range(0, num_rows, chunk_size):
+                writer.write_datasets(merged_start + start, {name: f['observed'][name][start:start + chunk_size] for name in writer.datasets})
+            merged_start += num_rows
+        writer.close()
+    finally:
+        for f in chrom_files:
+            f.close()
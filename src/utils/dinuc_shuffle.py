@@ -0,0 +1,41 @@
+import numpy as np
+
+
+def dinuc_shuffle_codes(codes, seeds):
+    # batched dinucleotide shuffle of rows of ASCII codes, identical to deeplift's dinuc_shuffle with a RandomState(seed) per row
+    num_seqs, seq_len = codes.shape
+    shuffled = np.empty_like(codes)
+    if num_seqs == 0 or seq_len == 0:
+        return shuffled
+    rows = np.arange(num_seqs)
+
+    # positions following each base, grouped by base code and in position
+    # order within each group, with each group's start in the row
+    next_pos = np.argsort(codes[:, :-1], axis=1, kind='stable') + 1
+    counts = np.bincount((rows[:, None] * 256 + codes[:, :-1]).ravel(), minlength=num_seqs * 256).reshape((num_seqs, 256))
+    offsets = np.cumsum(counts, axis=1) - counts
+
+    # deeplift permutes all but the last of each base's following positions,
+    # in order of base code; bases followed once or never draw no numbers.
+    # reseeding one RandomState gives the same stream as a new one per row
+    rng = np.random.RandomState()
+    for i in range(num_seqs):
+        rng.seed(seeds[i])
+        for code in np.flatnonzero(counts[i] > 1):
+            group = next_pos[i, offsets[i, code]:offsets[i, code] + counts[i, code] - 1]
+            group[:] = group[rng.permutation(len(group))]
+
+    # each step follows the next unused position after the previous base
+    codes_flat = codes.ravel()
+    next_flat = next_pos.ravel()
+    offsets_flat = (offsets + (rows * (seq_len - 1))[:, None]).ravel()
+    used_flat = np.zeros(num_seqs * 256, dtype=np.int64)
+    row_starts = rows * seq_len
+    row_codes = rows * 256
+    shuffled[:, 0] = codes[:, 0]
+    for j in range(1, seq_len):
+        code_idx = row_codes + shuffled[:, j - 1]
+        pos = next_flat[offsets_flat[code_idx] + used_flat[code_idx]]
+        used_flat[code_idx] += 1
+        shuffled[:, j] = codes_flat[row_starts + pos]
+    return shuffled
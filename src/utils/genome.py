@@ -0,0 +1,69 @@
+import os
+import numpy as np
+import pandas as pd
+import pyfaidx
+
+GENOME_CACHE_INDEX = "index.tsv"
+
+
+def write_genome_cache(genome_fasta, out_dir, chunk_size=10000000):
+    # one flat file of uint8 ASCII bases per chromosome, stored exactly as in the FASTA, plus an index of chromosome, file and length
+    os.makedirs(out_dir, exist_ok=True)
+    fasta = pyfaidx.Fasta(genome_fasta)
+    index = []
+    for i, chrom in enumerate(fasta.keys()):
+        chrom_len = len(fasta[chrom])
+        file_name = "%d.u8" % i
+        with open(os.path.join(out_dir, file_name), 'wb') as f:
+            for start in range(0, chrom_len, chunk_size):
+                f.write(str(fasta[chrom][start:min(start + chunk_size, chrom_len)]).encode("ascii"))
+        index.append([chrom, file_name, chrom_len])
+        print(chrom, chrom_len)
+
+    index = pd.DataFrame(index, columns=['chrom', 'file', 'size'])
+    index.to_csv(os.path.join(out_dir, GENOME_CACHE_INDEX), header=False, sep='\t', index=False)
+    return index
+
+def is_genome_cache(genome_path):
+    return os.path.isdir(genome_path) and os.path.isfile(os.path.join(genome_path, GENOME_CACHE_INDEX))
+
+def load_genome(genome_path):
+    # a FASTA file or a genome cache, whose fetch reads 0-based, end-exclusive windows as uint8 ASCII codes
+    if is_genome_cache(genome_path):
+        return GenomeCache(genome_path)
+    return FastaGenome(genome_path)
+
+
+class FastaGenome:
+    def __init__(self, genome_fasta):
+        self.fasta = pyfaidx.Fasta(genome_fasta)
+
+    def fetch(self, chrom, start, end):
+        return np.frombuffer(str(self.fasta[chrom][start:end]).encode("ascii"), dtype=np.uint8)
+
+    def keys(self):
+        return self.fasta.keys()
+
+
+class GenomeCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        index = pd.read_csv(os.path.join(cache_dir, GENOME_CACHE_INDEX), header=None, sep='\t',
+                            names=['chrom', 'file', 'size'], dtype={'chrom': str})
+        self.index = index.set_index('chrom')
+        self.chroms = {}
+
+    def __getitem__(self, chrom):
+        # memory-map each chromosome on first use; pages are shared between
+        # processes reading the same cache through the OS page cache
+        if chrom not in self.chroms:
+            entry = self.index.loc[chrom]
+            self.chroms[chrom] = np.memmap(os.path.join(self.cache_dir, entry['file']),
+                                           dtype=np.uint8, mode='r', shape=(int(entry['size']),))
+        return self.chroms[chrom]
+
+    def fetch(self, chrom, start, end):
+        return self[chrom][start:end]
+
+    def keys(self):
+        return self.index.index.tolist()
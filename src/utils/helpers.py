@@ -5,11 +5,33 @@ from scipy.spatial.distance import jensenshannon
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
+import contextlib
+import math
 import sys
+import os
 sys.path.append('..')
 from generators.variant_generator import VariantGenerator
 from generators.peak_generator import PeakGenerator
+from generators.prefetcher import BatchPrefetcher
 from utils import losses
+from utils.null_distribution import NullDistribution, NULL_SCORE_TAILS
+from utils.prediction_cache import get_model_fingerprint
+from utils.journal import BatchJournal
+from utils.scoring_head import VariantScoringHead
+from utils.inference_engine import get_inference_engine
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.csv
+    CSV_ENGINE = 'pyarrow'
+except ImportError:
+    CSV_ENGINE = 'c'
+
+try:
+    from isal import igzip_threaded
+except ImportError:
+    igzip_threaded = None
 
 
 def get_variant_schema(schema):
@@ -37,6 +59,32 @@ def get_valid_peaks(chrom, pos, summit, input_len, chrom_sizes_dict):
     else:
         return False
 
+def get_valid_window_mask(chroms, centers, input_len, chrom_sizes_dict):
+    # vectorized bounds check of the input windows centered at `centers`,
+    # returning the mask of valid rows and the number of rows rejected for each reason
+    chrom_sizes = pd.Series(chroms).map(chrom_sizes_dict).to_numpy(dtype=float)
+    centers = np.asarray(centers)
+    flank = input_len // 2
+    valid_chrom = ~np.isnan(chrom_sizes)
+    lower_check = (centers - flank > 0)
+    upper_check = (centers + flank <= chrom_sizes)
+    valid = valid_chrom & lower_check & upper_check
+    rejected = {"chromosome not in chrom sizes": int(np.sum(~valid_chrom)),
+                "window starts before the chromosome": int(np.sum(valid_chrom & ~lower_check)),
+                "window ends past the chromosome": int(np.sum(valid_chrom & lower_check & ~upper_check))}
+    return valid, rejected
+
+def get_valid_variants_mask(variants_table, input_len, chrom_sizes_dict):
+    return get_valid_window_mask(variants_table['chr'].values, variants_table['pos'].values, input_len, chrom_sizes_dict)
+
+def get_valid_peaks_mask(peaks, input_len, chrom_sizes_dict):
+    return get_valid_window_mask(peaks['chr'].values, (peaks['start'] + peaks['summit']).values, input_len, chrom_sizes_dict)
+
+def print_rejected_counts(rejected):
+    for reason, count in rejected.items():
+        if count > 0:
+            print("  rejected (" + reason + "):", count)
+
 def get_valid_variants(chrom, pos, allele1, allele2, input_len, chrom_sizes_dict):
     valid_chrom = chrom in chrom_sizes_dict
     if valid_chrom:
@@ -57,6 +105,48 @@ def softmax(x, temp=1):
     norm_x = x - np.mean(x, axis=1, keepdims=True)
     return np.exp(temp*norm_x)/np.sum(np.exp(temp*norm_x), axis=1, keepdims=True)
 
+def softmax_with_log_normalizers(x):
+    # float32 softmax of each row, and the float64 log-sum-exp normalizer of the row
+    row_max = np.max(x, axis=1, keepdims=True)
+    exp_x = np.exp(x - row_max)
+    row_sum = np.sum(exp_x, axis=1, keepdims=True, dtype=np.float64)
+    exp_x /= row_sum.astype(np.float32)
+    return exp_x, row_max + np.log(row_sum)
+
+def jensenshannon_distance(logits1, logits2, chunk_size=128):
+    # base-2 Jensen-Shannon distance between softmax(logits1) and softmax(logits2) of each row, in float32 log space;
+    # log p - log m = -log1p(expm1(d) / 2) with d = log q - log p keeps the precision of near-identical profiles
+    assert logits1.shape == logits2.shape
+    max_d = np.float32(80)
+    jsd = np.empty(len(logits1), dtype=np.float64)
+    for chunk_start in range(0, len(logits1), chunk_size):
+        x1 = np.asarray(logits1[chunk_start:chunk_start + chunk_size], dtype=np.float32)
+        x2 = np.asarray(logits2[chunk_start:chunk_start + chunk_size], dtype=np.float32)
+        p, log_z1 = softmax_with_log_normalizers(x1)
+        q, log_z2 = softmax_with_log_normalizers(x2)
+        d = x2 - x1
+        d -= (log_z2 - log_z1).astype(np.float32)
+
+        log_p_m = np.minimum(d, max_d)
+        np.expm1(log_p_m, out=log_p_m)
+        log_p_m *= np.float32(0.5)
+        np.log1p(log_p_m, out=log_p_m)
+        log_p_m += np.maximum(d - max_d, 0)
+        np.negative(log_p_m, out=log_p_m)
+
+        # p * (log p - log m) + q * (log q - log m) = (p + q) * (log p - log m) + q * d
+        p += q
+        p *= log_p_m
+        q *= d
+        p += q
+        js = np.sum(p, axis=1, dtype=np.float64) / (2 * np.log(2))
+        jsd[chunk_start:chunk_start + len(x1)] = np.sqrt(np.maximum(js, 0))
+
+    return jsd
+
+# all-zero bias inputs of chrombpnet-lite models, keyed by batch shape
+LITE_BIAS_INPUTS = {}
+
 def load_model_wrapper(model_file):
     # read .h5 model
     custom_objects = {"multinomial_nll": losses.multinomial_nll, "tf": tf}
@@ -65,154 +155,433 @@ def load_model_wrapper(model_file):
     print("model loaded succesfully")
     return model
 
-def fetch_peak_predictions(model, peaks, input_len, genome_fasta, batch_size, debug_mode=False, lite=False,forward_only=False):
-    peak_ids = []
-    pred_counts = []
-    pred_profiles = []
-    if not forward_only:
-        revcomp_counts = []
-        revcomp_profiles = []
-
-    # peak sequence generator
-    peak_gen = PeakGenerator(peaks=peaks,
-                             input_len=input_len,
-                             genome_fasta=genome_fasta,
-                             batch_size=batch_size,
-                             debug_mode=debug_mode)
-
-    for i in tqdm(range(len(peak_gen))):
-        batch_peak_ids, seqs = peak_gen[i]
-        revcomp_seq = seqs[:, ::-1, ::-1]
-
-        if lite:
-            batch_preds = model.predict([seqs,
-                                         np.zeros((len(seqs), model.output_shape[0][1])),
-                                         np.zeros((len(seqs), ))],
-                                        verbose=False)
-
-            if not forward_only:
-                revcomp_batch_preds = model.predict([revcomp_seq,
-                                             np.zeros((len(revcomp_seq), model.output_shape[0][1])),
-                                             np.zeros((len(revcomp_seq), ))],
-                                            verbose=False)
+def get_model_out_prefixes(out_prefix, model_files):
+    # a single model writes to out_prefix itself, while several models each write to
+    # out_prefix.<model file name>, or out_prefix.model<i> if the file names collide
+    if len(model_files) == 1:
+        return [out_prefix]
+    names = [os.path.splitext(os.path.basename(x))[0] for x in model_files]
+    if len(set(names)) < len(names):
+        names = ['model' + str(i) for i in range(len(model_files))]
+    return ['.'.join([out_prefix, x]) for x in names]
+
+def get_lite_bias_inputs(model, num_seqs):
+    # all-zero bias inputs of a chrombpnet-lite model, cached by batch shape
+    key = (num_seqs, model.output_shape[0][1])
+    if key not in LITE_BIAS_INPUTS:
+        LITE_BIAS_INPUTS[key] = [np.zeros((num_seqs, model.output_shape[0][1])),
+                                 np.zeros((num_seqs, ))]
+    return LITE_BIAS_INPUTS[key]
+
+def predict_batches(model, seq_batches, lite=False, fused=False):
+    # one [profiles, logcounts] per array of sequences, through the model's compiled InferenceEngine if it has one;
+    # with `fused`, the arrays are stacked into a single model call
+    if fused and len(seq_batches) > 1:
+        splits = np.cumsum([len(seqs) for seqs in seq_batches])[:-1]
+        stacked_preds = predict_batches(model, [np.concatenate(seq_batches)], lite=lite)[0]
+        return [[profiles, logcounts] for profiles, logcounts in
+                zip(np.split(stacked_preds[0], splits), np.split(stacked_preds[1], splits))]
+
+    engine = get_inference_engine(model)
+    batch_preds = []
+    for seqs in seq_batches:
+        if engine is not None:
+            batch_preds.append(engine.predict(seqs))
+        elif lite:
+            batch_preds.append(model.predict([seqs] + get_lite_bias_inputs(model, len(seqs)), verbose=False))
         else:
-            batch_preds = model.predict(seqs, verbose=False)
-            if not forward_only:
-                revcomp_batch_preds = model.predict(revcomp_seq, verbose=False)
-
-        batch_preds[1] = np.array([batch_preds[1][i] for i in range(len(batch_preds[1]))])
-        pred_counts.extend(np.exp(batch_preds[1]))
-        pred_profiles.extend(np.array(batch_preds[0]))   # np.squeeze(softmax()) to get probability profile
-
-        if not forward_only:
-            revcomp_batch_preds[1] = np.array([revcomp_batch_preds[1][i] for i in range(len(revcomp_batch_preds[1]))])
-            revcomp_counts.extend(np.exp(revcomp_batch_preds[1]))
-            revcomp_profiles.extend(np.array(revcomp_batch_preds[0]))    # np.squeeze(softmax()) to get probability profile
-
-        peak_ids.extend(batch_peak_ids)
-
-    peak_ids = np.array(peak_ids)
-    pred_counts = np.array(pred_counts)
-    pred_profiles = np.array(pred_profiles)
-
-    if not forward_only:
-        revcomp_counts = np.array(revcomp_counts)
-        revcomp_profiles = np.array(revcomp_profiles)
-        average_counts = np.average([pred_counts,revcomp_counts],axis=0)
-        average_profiles = np.average([pred_profiles,revcomp_profiles[:,::-1]],axis=0)
-        return peak_ids,average_counts,average_profiles
+            batch_preds.append(model.predict(seqs, verbose=False))
+    return batch_preds
+
+def store_batch_predictions(batch_preds, revcomp_batch_preds, counts_out, profiles_out):
+    # writes the counts and profile logits of a batch into preallocated outputs, averaged with the reverse complement (flipped back) if given
+    if revcomp_batch_preds is None:
+        counts_out[:] = np.exp(batch_preds[1])
+        profiles_out[:] = batch_preds[0]
     else:
-        return peak_ids,pred_counts,pred_profiles
-
-def fetch_variant_predictions(model, variants_table, input_len, genome_fasta, batch_size, debug_mode=False, lite=False, shuf=False, forward_only=False):
-    variant_ids = []
-    allele1_pred_counts = []
-    allele2_pred_counts = []
-    allele1_pred_profiles = []
-    allele2_pred_profiles = []
+        counts_out[:] = (np.exp(batch_preds[1]) + np.exp(revcomp_batch_preds[1])) / 2
+        profiles_out[:] = (batch_preds[0] + revcomp_batch_preds[0][:, ::-1]) / 2
+
+def predict_with_cache(model, seqs, prediction_cache, counts_out, profiles_out, lite=False, fused=False, forward_only=False):
+    # as store_batch_predictions, with cached windows read from the cache and each missing distinct window predicted once
+    keys = prediction_cache.get_keys(model, seqs, forward_only=forward_only)
+    cached = prediction_cache.lookup(keys)
+    missing_idx = {}
+    for i, key in enumerate(keys):
+        if key in cached:
+            counts_out[i], profiles_out[i] = cached[key]
+        elif key not in missing_idx:
+            missing_idx[key] = i
+    if not missing_idx:
+        return
+
+    missing_seqs = seqs[list(missing_idx.values())]
+    seq_batches = [missing_seqs]
     if not forward_only:
-        revcomp_allele1_pred_counts = []
-        revcomp_allele2_pred_counts = []
-        revcomp_allele1_pred_profiles = []
-        revcomp_allele2_pred_profiles = []
-
-    # variant sequence generator
-    var_gen = VariantGenerator(variants_table=variants_table,
-                           input_len=input_len,
-                           genome_fasta=genome_fasta,
-                           batch_size=batch_size,
-                           debug_mode=False,
-                           shuf=shuf)
-
-    for i in tqdm(range(len(var_gen))):
-
-        batch_variant_ids, allele1_seqs, allele2_seqs = var_gen[i]
-        revcomp_allele1_seqs = allele1_seqs[:, ::-1, ::-1]
-        revcomp_allele2_seqs = allele2_seqs[:, ::-1, ::-1]
-
-        if lite:
-            allele1_batch_preds = model.predict([allele1_seqs,
-                                                 np.zeros((len(allele1_seqs), model.output_shape[0][1])),
-                                                 np.zeros((len(allele1_seqs), ))],
-                                                verbose=False)
-            allele2_batch_preds = model.predict([allele2_seqs,
-                                                 np.zeros((len(allele2_seqs), model.output_shape[0][1])),
-                                                 np.zeros((len(allele2_seqs), ))],
-                                                verbose=False)
-
-            if not forward_only:
-                revcomp_allele1_batch_preds = model.predict([revcomp_allele1_seqs,
-                                                     np.zeros((len(revcomp_allele1_seqs), model.output_shape[0][1])),
-                                                     np.zeros((len(revcomp_allele1_seqs), ))],
-                                                    verbose=False)
-                revcomp_allele2_batch_preds = model.predict([revcomp_allele2_seqs,
-                                         np.zeros((len(revcomp_allele2_seqs), model.output_shape[0][1])),
-                                         np.zeros((len(revcomp_allele2_seqs), ))],
-                                        verbose=False)
-        else:
-            allele1_batch_preds = model.predict(allele1_seqs, verbose=False)
-            allele2_batch_preds = model.predict(allele2_seqs, verbose=False)
-            if not forward_only:
-                revcomp_allele1_batch_preds = model.predict(revcomp_allele1_seqs, verbose=False)
-                revcomp_allele2_batch_preds = model.predict(revcomp_allele2_seqs, verbose=False)
-
-        allele1_batch_preds[1] = np.array([allele1_batch_preds[1][i] for i in range(len(allele1_batch_preds[1]))])
-        allele2_batch_preds[1] = np.array([allele2_batch_preds[1][i] for i in range(len(allele2_batch_preds[1]))])
-        allele1_pred_counts.extend(np.exp(allele1_batch_preds[1]))
-        allele2_pred_counts.extend(np.exp(allele2_batch_preds[1]))
-        allele1_pred_profiles.extend(np.array(allele1_batch_preds[0]))   # np.squeeze(softmax()) to get probability profile
-        allele2_pred_profiles.extend(np.array(allele2_batch_preds[0]))
-
+        seq_batches.append(missing_seqs[:, ::-1, ::-1])
+    all_batch_preds = predict_batches(model, seq_batches, lite=lite, fused=fused)
+    missing_counts = np.empty((len(missing_seqs), 1), dtype=np.float32)
+    missing_profiles = np.empty((len(missing_seqs), model.output_shape[0][1]), dtype=np.float32)
+    store_batch_predictions(all_batch_preds[0],
+                            None if forward_only else all_batch_preds[1],
+                            missing_counts,
+                            missing_profiles)
+    prediction_cache.insert(list(missing_idx), missing_counts, missing_profiles)
+
+    missing_pos = {key: j for j, key in enumerate(missing_idx)}
+    rows = [i for i, key in enumerate(keys) if key in missing_pos]
+    counts_out[rows] = missing_counts[[missing_pos[keys[i]] for i in rows]]
+    profiles_out[rows] = missing_profiles[[missing_pos[keys[i]] for i in rows]]
+
+def get_prediction_journal(journal_prefix, models, table, batch_size, settings, array_specs):
+    # the journal of a prediction stage is tied to the weights of its models
+    if journal_prefix is None or len(table) == 0:
+        return None
+    return BatchJournal(journal_prefix, table, batch_size,
+                        dict(settings, models=[get_model_fingerprint(x).hex() for x in models]),
+                        array_specs)
+
+def fetch_peak_predictions(model, peaks, input_len, genome_fasta, batch_size, debug_mode=False, lite=False,forward_only=False,
+                           num_workers=0, queue_depth=2, use_processes=False, fused=False, profile_dtype=np.float32,
+                           sharded_predictor=None, prediction_cache=None, journal_prefix=None):
+    # counts and profiles of every peak, as lists of one array per model for a list of models, journaled at journal_prefix if given
+    models = model if isinstance(model, list) else [model]
+    if sharded_predictor is not None:
+        peak_ids, pred_counts, pred_profiles = sharded_predictor.fetch_peak_predictions(peaks, batch_size, [x.output_shape[0][1] for x in models],
+                                                        profile_dtype=profile_dtype, input_len=input_len, genome_fasta=genome_fasta,
+                                                        debug_mode=debug_mode, lite=lite, forward_only=forward_only, num_workers=num_workers,
+                                                        queue_depth=queue_depth, use_processes=use_processes, fused=fused,
+                                                        prediction_cache=prediction_cache)
+        if not isinstance(model, list):
+            return peak_ids, pred_counts[0], pred_profiles[0]
+        return peak_ids, pred_counts, pred_profiles
+
+    journal = get_prediction_journal(journal_prefix, models, peaks, batch_size,
+                                     dict(input_len=input_len, genome_fasta=genome_fasta, lite=lite, forward_only=forward_only),
+                                     dict([('pred_counts.%d' % i, ((len(peaks), 1), np.float32)) for i in range(len(models))] +
+                                          [('pred_profiles.%d' % i, ((len(peaks), x.output_shape[0][1]), profile_dtype)) for i, x in enumerate(models)]))
+    if journal is not None:
+        pred_counts = [journal.arrays['pred_counts.%d' % i] for i in range(len(models))]
+        pred_profiles = [journal.arrays['pred_profiles.%d' % i] for i in range(len(models))]
+        batch_indices = journal.remaining_batches()
+    else:
+        pred_counts = [np.empty((len(peaks), 1), dtype=np.float32) for x in models]
+        pred_profiles = [np.empty((len(peaks), x.output_shape[0][1]), dtype=profile_dtype) for x in models]
+        batch_indices = range(math.ceil(len(peaks) / batch_size))
+    peak_ids = peaks['peak_id'].to_numpy(dtype=object, copy=True)
+
+    # peak sequence generator, with batches built ahead by the prefetch workers
+    peak_gen = BatchPrefetcher(PeakGenerator,
+                               dict(peaks=peaks,
+                                    input_len=input_len,
+                                    genome_fasta=genome_fasta,
+                                    batch_size=batch_size,
+                                    debug_mode=debug_mode,
+                                    num_buffers=1),
+                               num_workers=num_workers,
+                               queue_depth=queue_depth,
+                               use_processes=use_processes,
+                               batch_indices=batch_indices)
+
+    for batch_idx, (batch_peak_ids, seqs) in zip(peak_gen.batch_indices, tqdm(peak_gen)):
+        seq_batches = [seqs]
         if not forward_only:
-            revcomp_allele1_batch_preds[1] = np.array([revcomp_allele1_batch_preds[1][i] for i in range(len(revcomp_allele1_batch_preds[1]))])
-            revcomp_allele2_batch_preds[1] = np.array([revcomp_allele2_batch_preds[1][i] for i in range(len(revcomp_allele2_batch_preds[1]))])
-            revcomp_allele1_pred_counts.extend(np.exp(revcomp_allele1_batch_preds[1]))
-            revcomp_allele2_pred_counts.extend(np.exp(revcomp_allele2_batch_preds[1]))
-            revcomp_allele1_pred_profiles.extend(np.array(revcomp_allele1_batch_preds[0]))   # np.squeeze(softmax()) to get probability profile
-            revcomp_allele2_pred_profiles.extend(np.array(revcomp_allele2_batch_preds[0]))
-
-        variant_ids.extend(batch_variant_ids)
-
-    variant_ids = np.array(variant_ids)
-    allele1_pred_counts = np.array(allele1_pred_counts)
-    allele2_pred_counts = np.array(allele2_pred_counts)
-    allele1_pred_profiles = np.array(allele1_pred_profiles)
-    allele2_pred_profiles = np.array(allele2_pred_profiles)
+            seq_batches.append(seqs[:, ::-1, ::-1])
+
+        batch_start, batch_end = batch_idx * batch_size, batch_idx * batch_size + len(seqs)
+        for i in range(len(models)):
+            if prediction_cache is not None:
+                predict_with_cache(models[i], seqs, prediction_cache,
+                                   pred_counts[i][batch_start:batch_end],
+                                   pred_profiles[i][batch_start:batch_end],
+                                   lite=lite, fused=fused, forward_only=forward_only)
+                continue
+            all_batch_preds = predict_batches(models[i], seq_batches, lite=lite, fused=fused)
+            store_batch_predictions(all_batch_preds[0],
+                                    None if forward_only else all_batch_preds[1],
+                                    pred_counts[i][batch_start:batch_end],
+                                    pred_profiles[i][batch_start:batch_end])   # np.squeeze(softmax()) to get probability profile
+
+        peak_ids[batch_start:batch_end] = batch_peak_ids
+        if journal is not None:
+            journal.mark_done(batch_idx)
+
+    if journal is not None:
+        pred_counts, pred_profiles = [np.array(x) for x in pred_counts], [np.array(x) for x in pred_profiles]
+        journal.close()
+    peak_ids = np.array(peak_ids.tolist())
+    if not isinstance(model, list):
+        return peak_ids, pred_counts[0], pred_profiles[0]
+    return peak_ids, pred_counts, pred_profiles
+
+def iter_variant_predictions(model, variants_table, input_len, genome_fasta, batch_size, lite=False, shuf=False, forward_only=False,
+                             num_workers=0, queue_depth=2, use_processes=False, fused=False, profile_dtype=np.float32,
+                             prediction_cache=None, batch_indices=None):
+    # yields (batch_start, variant_ids, allele1/2 counts, allele1/2 profiles) for each batch,
+    # with lists of one array per model for a list of models
+    models = model if isinstance(model, list) else [model]
+
+    # variant sequence generator, with batches built ahead by the prefetch workers
+    var_gen = BatchPrefetcher(VariantGenerator,
+                              dict(variants_table=variants_table,
+                                   input_len=input_len,
+                                   genome_fasta=genome_fasta,
+                                   batch_size=batch_size,
+                                   debug_mode=False,
+                                   shuf=shuf,
+                                   num_buffers=1),
+                              num_workers=num_workers,
+                              queue_depth=queue_depth,
+                              use_processes=use_processes,
+                              batch_indices=batch_indices)
+
+    for batch_idx, (batch_variant_ids, allele1_seqs, allele2_seqs) in zip(var_gen.batch_indices, tqdm(var_gen)):
+        batch_start = batch_idx * batch_size
+        seq_batches = [allele1_seqs, allele2_seqs]
+        if not forward_only:
+            seq_batches.extend([allele1_seqs[:, ::-1, ::-1], allele2_seqs[:, ::-1, ::-1]])
+
+        allele1_pred_counts = [np.empty((len(batch_variant_ids), 1), dtype=np.float32) for x in models]
+        allele2_pred_counts = [np.empty((len(batch_variant_ids), 1), dtype=np.float32) for x in models]
+        allele1_pred_profiles = [np.empty((len(batch_variant_ids), x.output_shape[0][1]), dtype=profile_dtype) for x in models]
+        allele2_pred_profiles = [np.empty((len(batch_variant_ids), x.output_shape[0][1]), dtype=profile_dtype) for x in models]
+        for i in range(len(models)):
+            if prediction_cache is not None:
+                # both alleles are looked up and predicted together
+                num_variants = len(batch_variant_ids)
+                pred_counts = np.empty((2 * num_variants, 1), dtype=np.float32)
+                pred_profiles = np.empty((2 * num_variants, models[i].output_shape[0][1]), dtype=profile_dtype)
+                predict_with_cache(models[i], np.concatenate([allele1_seqs, allele2_seqs]), prediction_cache,
+                                   pred_counts, pred_profiles, lite=lite, fused=fused, forward_only=forward_only)
+                allele1_pred_counts[i][:], allele2_pred_counts[i][:] = pred_counts[:num_variants], pred_counts[num_variants:]
+                allele1_pred_profiles[i][:], allele2_pred_profiles[i][:] = pred_profiles[:num_variants], pred_profiles[num_variants:]
+                continue
+            all_batch_preds = predict_batches(models[i], seq_batches, lite=lite, fused=fused)
+            store_batch_predictions(all_batch_preds[0],
+                                    None if forward_only else all_batch_preds[2],
+                                    allele1_pred_counts[i],
+                                    allele1_pred_profiles[i])   # np.squeeze(softmax()) to get probability profile
+            store_batch_predictions(all_batch_preds[1],
+                                    None if forward_only else all_batch_preds[3],
+                                    allele2_pred_counts[i],
+                                    allele2_pred_profiles[i])
+
+        if not isinstance(model, list):
+            yield batch_start, batch_variant_ids, allele1_pred_counts[0], allele2_pred_counts[0], \
+                  allele1_pred_profiles[0], allele2_pred_profiles[0]
+        else:
+            yield batch_start, batch_variant_ids, allele1_pred_counts, allele2_pred_counts, \
+                  allele1_pred_profiles, allele2_pred_profiles
+
+def iter_variant_scores(model, variants_table, input_len, genome_fasta, batch_size, lite=False, forward_only=False,
+                        num_workers=0, queue_depth=2, use_processes=False, profile_dtype=np.float32, return_profiles=False):
+    # as iter_variant_predictions, with logfc and jsd from a VariantScoringHead;
+    # the profiles are None unless returned or needed for the indels of the batch
+    models = model if isinstance(model, list) else [model]
+    scoring_heads = [VariantScoringHead(x, lite=lite, forward_only=forward_only) for x in models]
+    is_indel = get_allele_lengths(variants_table['allele1'].values) != get_allele_lengths(variants_table['allele2'].values)
+
+    var_gen = BatchPrefetcher(VariantGenerator,
+                              dict(variants_table=variants_table,
+                                   input_len=input_len,
+                                   genome_fasta=genome_fasta,
+                                   batch_size=batch_size,
+                                   debug_mode=False,
+                                   shuf=False,
+                                   num_buffers=1),
+                              num_workers=num_workers,
+                              queue_depth=queue_depth,
+                              use_processes=use_processes)
+
+    for batch_idx, (batch_variant_ids, allele1_seqs, allele2_seqs) in zip(var_gen.batch_indices, tqdm(var_gen)):
+        batch_start = batch_idx * batch_size
+        batch_return_profiles = return_profiles or bool(is_indel[batch_start:batch_start + len(batch_variant_ids)].any())
+        outputs = [x(allele1_seqs, allele2_seqs, return_profiles=batch_return_profiles) for x in scoring_heads]
+        batch_outputs = [[x[name] for x in outputs] for name in ['allele1_pred_counts', 'allele2_pred_counts', 'logfc', 'jsd']]
+        if batch_return_profiles:
+            batch_outputs += [[x[name].astype(profile_dtype, copy=False) for x in outputs]
+                              for name in ['allele1_pred_profiles', 'allele2_pred_profiles']]
+        else:
+            batch_outputs += [[None for x in outputs] for name in ['allele1_pred_profiles', 'allele2_pred_profiles']]
 
-    if not forward_only:
-        revcomp_allele1_pred_counts = np.array(revcomp_allele1_pred_counts)
-        revcomp_allele2_pred_counts = np.array(revcomp_allele2_pred_counts)
-        revcomp_allele1_pred_profiles = np.array(revcomp_allele1_pred_profiles)
-        revcomp_allele2_pred_profiles = np.array(revcomp_allele2_pred_profiles)
-        average_allele1_pred_counts = np.average([allele1_pred_counts,revcomp_allele1_pred_counts],axis=0)
-        average_allele1_pred_profiles = np.average([allele1_pred_profiles,revcomp_allele1_pred_profiles[:,::-1]],axis=0)
-        average_allele2_pred_counts = np.average([allele2_pred_counts,revcomp_allele2_pred_counts],axis=0)
-        average_allele2_pred_profiles = np.average([allele2_pred_profiles,revcomp_allele2_pred_profiles[:,::-1]],axis=0)
-        return variant_ids, average_allele1_pred_counts, average_allele2_pred_counts, \
-               average_allele1_pred_profiles, average_allele2_pred_profiles
+        if not isinstance(model, list):
+            yield (batch_start, batch_variant_ids) + tuple(x[0] for x in batch_outputs)
+        else:
+            yield (batch_start, batch_variant_ids) + tuple(batch_outputs)
+
+def fetch_variant_predictions(model, variants_table, input_len, genome_fasta, batch_size, debug_mode=False, lite=False, shuf=False, forward_only=False,
+                              num_workers=0, queue_depth=2, use_processes=False, fused=False, profile_dtype=np.float32,
+                              sharded_predictor=None, prediction_cache=None, journal_prefix=None):
+    # counts and profiles of both alleles of every variant, as with fetch_peak_predictions
+    models = model if isinstance(model, list) else [model]
+    if sharded_predictor is not None:
+        predictions = sharded_predictor.fetch_variant_predictions(variants_table, batch_size, [x.output_shape[0][1] for x in models],
+                                                        profile_dtype=profile_dtype, input_len=input_len, genome_fasta=genome_fasta,
+                                                        debug_mode=debug_mode, lite=lite, shuf=shuf, forward_only=forward_only,
+                                                        num_workers=num_workers, queue_depth=queue_depth, use_processes=use_processes, fused=fused,
+                                                        prediction_cache=prediction_cache)
+        if not isinstance(model, list):
+            return (predictions[0],) + tuple(x[0] for x in predictions[1:])
+        return predictions
+
+    array_specs = {}
+    for i, x in enumerate(models):
+        for allele in ['allele1', 'allele2']:
+            array_specs['%s_pred_counts.%d' % (allele, i)] = ((len(variants_table), 1), np.float32)
+            array_specs['%s_pred_profiles.%d' % (allele, i)] = ((len(variants_table), x.output_shape[0][1]), profile_dtype)
+    journal = get_prediction_journal(journal_prefix, models, variants_table, batch_size,
+                                     dict(input_len=input_len, genome_fasta=genome_fasta, lite=lite, forward_only=forward_only, shuf=shuf),
+                                     array_specs)
+    if journal is not None:
+        predictions = [[journal.arrays['%s.%d' % (name, i)] for i in range(len(models))]
+                       for name in ['allele1_pred_counts', 'allele2_pred_counts', 'allele1_pred_profiles', 'allele2_pred_profiles']]
+        batch_indices = journal.remaining_batches()
+    else:
+        predictions = [[np.empty(array_specs['%s.%d' % (name, i)][0], dtype=array_specs['%s.%d' % (name, i)][1]) for i in range(len(models))]
+                       for name in ['allele1_pred_counts', 'allele2_pred_counts', 'allele1_pred_profiles', 'allele2_pred_profiles']]
+        batch_indices = None
+    allele1_pred_counts, allele2_pred_counts, allele1_pred_profiles, allele2_pred_profiles = predictions
+    variant_ids = variants_table['variant_id'].to_numpy(dtype=object, copy=True)
+
+    for batch_start, batch_variant_ids, batch_allele1_pred_counts, batch_allele2_pred_counts, \
+        batch_allele1_pred_profiles, batch_allele2_pred_profiles in iter_variant_predictions(models,
+                                                                                            variants_table,
+                                                                                            input_len,
+                                                                                            genome_fasta,
+                                                                                            batch_size,
+                                                                                            lite=lite,
+                                                                                            shuf=shuf,
+                                                                                            forward_only=forward_only,
+                                                                                            num_workers=num_workers,
+                                                                                            queue_depth=queue_depth,
+                                                                                            use_processes=use_processes,
+                                                                                            fused=fused,
+                                                                                            profile_dtype=profile_dtype,
+                                                                                            prediction_cache=prediction_cache,
+                                                                                            batch_indices=batch_indices):
+        batch_end = batch_start + len(batch_variant_ids)
+        for i in range(len(models)):
+            allele1_pred_counts[i][batch_start:batch_end] = batch_allele1_pred_counts[i]
+            allele2_pred_counts[i][batch_start:batch_end] = batch_allele2_pred_counts[i]
+            allele1_pred_profiles[i][batch_start:batch_end] = batch_allele1_pred_profiles[i]
+            allele2_pred_profiles[i][batch_start:batch_end] = batch_allele2_pred_profiles[i]
+        variant_ids[batch_start:batch_end] = batch_variant_ids
+        if journal is not None:
+            journal.mark_done(batch_start // batch_size)
+
+    if journal is not None:
+        allele1_pred_counts, allele2_pred_counts, allele1_pred_profiles, allele2_pred_profiles = \
+            [[np.array(x) for x in arrays] for arrays in predictions]
+        journal.close()
+    variant_ids = np.array(variant_ids.tolist())
+    if not isinstance(model, list):
+        return variant_ids, allele1_pred_counts[0], allele2_pred_counts[0], \
+               allele1_pred_profiles[0], allele2_pred_profiles[0]
+    return variant_ids, allele1_pred_counts, allele2_pred_counts, \
+           allele1_pred_profiles, allele2_pred_profiles
+
+def iter_table_variant_predictions(model, variants_tables, input_len, genome_fasta, batch_size, debug_mode=False, lite=False, shuf=False,
+                                   forward_only=False, num_workers=0, queue_depth=2, use_processes=False, fused=False,
+                                   profile_dtype=np.float32, sharded_predictor=None, prediction_cache=None, journal_prefixes=None):
+    # yields (table index, predictions) for each table, with whole tables spread over the sharded workers if given
+    models = model if isinstance(model, list) else [model]
+    if sharded_predictor is not None:
+        for predictions in sharded_predictor.iter_table_variant_predictions(variants_tables, batch_size,
+                                                        [x.output_shape[0][1] for x in models],
+                                                        profile_dtype=profile_dtype, input_len=input_len, genome_fasta=genome_fasta,
+                                                        debug_mode=debug_mode, lite=lite, shuf=shuf, forward_only=forward_only,
+                                                        num_workers=num_workers, queue_depth=queue_depth, use_processes=use_processes, fused=fused,
+                                                        prediction_cache=prediction_cache):
+            if not isinstance(model, list):
+                predictions = predictions[:2] + tuple(x[0] for x in predictions[2:])
+            yield predictions
+        return
+
+    for i, variants_table in enumerate(variants_tables):
+        yield (i,) + fetch_variant_predictions(model,
+                                               variants_table,
+                                               input_len,
+                                               genome_fasta,
+                                               batch_size,
+                                               debug_mode=debug_mode,
+                                               lite=lite,
+                                               shuf=shuf,
+                                               forward_only=forward_only,
+                                               num_workers=num_workers,
+                                               queue_depth=queue_depth,
+                                               use_processes=use_processes,
+                                               fused=fused,
+                                               profile_dtype=profile_dtype,
+                                               prediction_cache=prediction_cache,
+                                               journal_prefix=journal_prefixes[i] if journal_prefixes else None)
+
+def score_variants(variants_table, allele1_pred_counts, allele2_pred_counts,
+                   allele1_pred_profiles, allele2_pred_profiles,
+                   peak_pred_counts=None, shuf_variants_table=None, null_distribution=None, logfc=None, jsd=None):
+    # adds the counts and scores, and the peak quantiles and null p-values if given, to a table lining up with the predictions;
+    # logfc and jsd from a VariantScoringHead are used as they are
+    if null_distribution is None and shuf_variants_table is not None:
+        null_distribution = NullDistribution(shuf_variants_table)
+
+    if logfc is not None:
+        if peak_pred_counts is not None:
+            sorted_pred_counts = np.sort(np.ravel(peak_pred_counts))
+            allele1_quantile = get_quantiles(allele1_pred_counts, sorted_pred_counts)
+            allele2_quantile = get_quantiles(allele2_pred_counts, sorted_pred_counts)
+    elif peak_pred_counts is not None:
+        logfc, jsd, \
+        allele1_quantile, allele2_quantile = get_variant_scores_with_peaks(allele1_pred_counts,
+                                                                           allele2_pred_counts,
+                                                                           allele1_pred_profiles,
+                                                                           allele2_pred_profiles,
+                                                                           peak_pred_counts)
+    else:
+        logfc, jsd = get_variant_scores(allele1_pred_counts,
+                                        allele2_pred_counts,
+                                        allele1_pred_profiles,
+                                        allele2_pred_profiles)
+    logfc = np.reshape(logfc, -1)
+    jsd = np.reshape(jsd, -1)
+
+    indel_idx, adjusted_jsd_list = adjust_indel_jsd(variants_table, allele1_pred_profiles, allele2_pred_profiles, jsd)
+    has_indel_variants = (len(indel_idx) > 0)
+
+    variants_table["allele1_pred_counts"] = allele1_pred_counts
+    variants_table["allele2_pred_counts"] = allele2_pred_counts
+    variants_table["logfc"] = logfc
+    variants_table["abs_logfc"] = np.abs(variants_table["logfc"])
+    if has_indel_variants:
+        variants_table["jsd"] = adjusted_jsd_list
     else:
-        return variant_ids, allele1_pred_counts, allele2_pred_counts, \
-               allele1_pred_profiles, allele2_pred_profiles
+        variants_table["jsd"] = jsd
+        assert np.array_equal(adjusted_jsd_list, jsd)
+    variants_table["original_jsd"] = jsd
+    variants_table["logfc_x_jsd"] = variants_table["logfc"] * variants_table["jsd"]
+    variants_table["abs_logfc_x_jsd"] = variants_table["abs_logfc"] * variants_table["jsd"]
+
+    if null_distribution is not None:
+        pvals = null_distribution.get_pvals(variants_table, scores=["logfc", "abs_logfc", "jsd", "logfc_x_jsd", "abs_logfc_x_jsd"])
+        for score in pvals:
+            variants_table[score + ".pval"] = pvals[score]
+
+    if peak_pred_counts is not None:
+        variants_table["allele1_quantile"] = allele1_quantile
+        variants_table["allele2_quantile"] = allele2_quantile
+        variants_table["active_allele_quantile"] = variants_table[["allele1_quantile", "allele2_quantile"]].max(axis=1)
+        variants_table["quantile_change"] = variants_table["allele2_quantile"] - variants_table["allele1_quantile"]
+        variants_table["abs_quantile_change"] = np.abs(variants_table["quantile_change"])
+        variants_table["logfc_x_active_allele_quantile"] = variants_table["logfc"] * variants_table["active_allele_quantile"]
+        variants_table["abs_logfc_x_active_allele_quantile"] = variants_table["abs_logfc"] * variants_table["active_allele_quantile"]
+        variants_table["jsd_x_active_allele_quantile"] = variants_table["jsd"] * variants_table["active_allele_quantile"]
+        variants_table["logfc_x_jsd_x_active_allele_quantile"] = variants_table["logfc_x_jsd"] * variants_table["active_allele_quantile"]
+        variants_table["abs_logfc_x_jsd_x_active_allele_quantile"] = variants_table["abs_logfc_x_jsd"] * variants_table["active_allele_quantile"]
+
+        if null_distribution is not None:
+            pvals = null_distribution.get_pvals(variants_table, scores=[x for x, tail in NULL_SCORE_TAILS[5:]])
+            for score in pvals:
+                variants_table[score + ".pval"] = pvals[score]
+
+    return variants_table
 
 def get_variant_scores_with_peaks(allele1_pred_counts, allele2_pred_counts,
                        allele1_pred_profiles, allele2_pred_profiles, pred_counts):
@@ -221,91 +590,145 @@ def get_variant_scores_with_peaks(allele1_pred_counts, allele2_pred_counts,
 
     logfc, jsd = get_variant_scores(allele1_pred_counts, allele2_pred_counts,
                                     allele1_pred_profiles, allele2_pred_profiles)
-    allele1_quantile = np.array([np.max([np.mean(pred_counts < x), (1/len(pred_counts))]) for x in allele1_pred_counts])
-    allele2_quantile = np.array([np.max([np.mean(pred_counts < x), (1/len(pred_counts))]) for x in allele2_pred_counts])
+    sorted_pred_counts = np.sort(np.ravel(pred_counts))
+    allele1_quantile = get_quantiles(allele1_pred_counts, sorted_pred_counts)
+    allele2_quantile = get_quantiles(allele2_pred_counts, sorted_pred_counts)
 
     return logfc, jsd, allele1_quantile, allele2_quantile
 
+def get_quantiles(obs, sorted_bg):
+    # fraction of the background strictly below each observation, floored at 1/len(bg);
+    # NaN observations are below nothing, and NaNs in the background sort past every number
+    obs = np.ravel(obs)
+    num_below = np.searchsorted(sorted_bg, obs, side='left')
+    num_below[np.isnan(obs)] = 0
+    return np.maximum(num_below / len(sorted_bg), 1 / len(sorted_bg))
+
 def get_variant_scores(allele1_pred_counts, allele2_pred_counts,
                        allele1_pred_profiles, allele2_pred_profiles):
-
-    print('allele1_pred_counts shape:', allele1_pred_counts.shape)
-    print('allele2_pred_counts shape:', allele2_pred_counts.shape)
-    print('allele1_pred_profiles shape:', allele1_pred_profiles.shape)
-    print('allele2_pred_profiles shape:', allele2_pred_profiles.shape)
-
     logfc = np.squeeze(np.log2(allele2_pred_counts / allele1_pred_counts))
-    jsd = np.squeeze([jensenshannon(x, y, base=2.0)
-                     for x,y in zip(softmax(allele2_pred_profiles),
-                                    softmax(allele1_pred_profiles))])
-
-    print('logfc shape:', logfc.shape)
-    print('jsd shape:', jsd.shape)
+    jsd = jensenshannon_distance(allele2_pred_profiles, allele1_pred_profiles)
 
     return logfc, jsd
 
-def adjust_indel_jsd(variants_table,allele1_pred_profiles,allele2_pred_profiles,original_jsd):
-    indel_idx = []
-    for i, row in variants_table.iterrows():
-        allele1, allele2 = row[['allele1','allele2']]
-        if allele1 == "-":
-            allele1 = ""
-        if allele2 == "-":
-            allele2 = ""
-        if len(allele1) != len(allele2):
-            indel_idx += [i]
-
-    adjusted_jsd = []
-    for i in indel_idx:
-        row = variants_table.iloc[i]
-        allele1, allele2 = row[['allele1','allele2']]
-        if allele1 == "-":
-            allele1 = ""
-        if allele2 == "-":
-            allele2 = ""
-
-        allele1_length = len(allele1)
-        allele2_length = len(allele2)
-
-        allele1_p = allele1_pred_profiles[i]
-        allele2_p = allele2_pred_profiles[i]
-        assert len(allele1_p) == len(allele2_p)
-        assert allele1_length != allele2_length
-        flank_size = len(allele1_p)//2
-        allele1_left_flank = allele1_p[:flank_size]
-        allele2_left_flank = allele2_p[:flank_size]
-
-        if allele1_length > allele2_length:
-            allele1_right_flank = np.concatenate([allele1_p[flank_size:flank_size+allele2_length],allele1_p[flank_size+allele1_length:]])
-            allele2_right_flank = allele2_p[flank_size:allele2_length-allele1_length]
-        else:
-            allele1_right_flank = allele1_p[flank_size:allele1_length-allele2_length]
-            allele2_right_flank = np.concatenate([allele2_p[flank_size:flank_size+allele1_length], allele2_p[flank_size+allele2_length:]])
+def get_allele_lengths(alleles):
+    # "-" stands for an empty allele
+    alleles = pd.Series(alleles)
+    return np.where(alleles == "-", 0, alleles.str.len()).astype(int)
 
-
-        adjusted_allele1_p = np.concatenate([allele1_left_flank,allele1_right_flank])
-        adjusted_allele2_p = np.concatenate([allele2_left_flank,allele2_right_flank])
-        adjusted_allele1_p = adjusted_allele1_p/np.sum(adjusted_allele1_p)
-        adjusted_allele2_p = adjusted_allele2_p/np.sum(adjusted_allele2_p)
-        assert len(adjusted_allele1_p) == len(adjusted_allele2_p)
-        adjusted_j = jensenshannon(adjusted_allele1_p,adjusted_allele2_p,base=2.0)
-        adjusted_jsd += [adjusted_j]
+def adjust_indel_jsd(variants_table,allele1_pred_profiles,allele2_pred_profiles,original_jsd,chunk_size=1024):
+    # recompute the jsd of indels between the allele profiles with the inserted bases
+    # cut out of the longer allele's profile and the shorter allele's profile trimmed
+    # to the same length; rows are grouped by allele lengths so each group shares the
+    # same kept profile columns
+    allele1_lengths = get_allele_lengths(variants_table['allele1'].values)
+    allele2_lengths = get_allele_lengths(variants_table['allele2'].values)
+    indel_idx = np.flatnonzero(allele1_lengths != allele2_lengths)
 
     adjusted_jsd_list = original_jsd.copy()
-    if len(indel_idx) > 0:
-        for i in range(len(indel_idx)):
-            idx = indel_idx[i]
-            adjusted_jsd_list[idx] = adjusted_jsd[i]
+    if len(indel_idx) == 0:
+        return indel_idx, adjusted_jsd_list
+
+    profile_len = allele1_pred_profiles.shape[1]
+    flank_size = profile_len//2
+    columns = np.arange(profile_len)
+    length_pairs, group_idx = np.unique(np.stack([allele1_lengths[indel_idx], allele2_lengths[indel_idx]], axis=1),
+                                        axis=0, return_inverse=True)
+    group_idx = np.ravel(group_idx)
+    group_ends = np.cumsum(np.bincount(group_idx))
+    groups = np.split(indel_idx[np.argsort(group_idx, kind='stable')], group_ends[:-1])
+
+    for (allele1_length, allele2_length), group in zip(length_pairs, groups):
+        if allele1_length > allele2_length:
+            allele1_columns = np.concatenate([columns[:flank_size], columns[flank_size:flank_size+allele2_length], columns[flank_size+allele1_length:]])
+            allele2_columns = np.concatenate([columns[:flank_size], columns[flank_size:allele2_length-allele1_length]])
+        else:
+            allele1_columns = np.concatenate([columns[:flank_size], columns[flank_size:allele1_length-allele2_length]])
+            allele2_columns = np.concatenate([columns[:flank_size], columns[flank_size:flank_size+allele1_length], columns[flank_size+allele2_length:]])
+        assert len(allele1_columns) == len(allele2_columns)
+
+        for chunk_start in range(0, len(group), chunk_size):
+            rows = group[chunk_start:chunk_start + chunk_size]
+            adjusted_allele1_p = allele1_pred_profiles[rows[:, None], allele1_columns]
+            adjusted_allele2_p = allele2_pred_profiles[rows[:, None], allele2_columns]
+            adjusted_allele1_p = adjusted_allele1_p/np.sum(adjusted_allele1_p, axis=1, keepdims=True)
+            adjusted_allele2_p = adjusted_allele2_p/np.sum(adjusted_allele2_p, axis=1, keepdims=True)
+            adjusted_jsd_list[rows] = jensenshannon(adjusted_allele1_p,adjusted_allele2_p,base=2.0,axis=1)
 
     return indel_idx, adjusted_jsd_list
 
-def load_variant_table(table_path, schema):
-    variants_table = pd.read_csv(table_path, header=None, sep='\t', names=get_variant_schema(schema))
+def open_variant_list(table_path):
+    # gzipped lists are decompressed by a background thread with python-isal when it is
+    # installed, so that decompression overlaps with parsing; other paths are left to pandas
+    if igzip_threaded is not None and str(table_path).endswith('.gz'):
+        return igzip_threaded.open(table_path, 'rb', threads=1)
+    return contextlib.nullcontext(table_path)
+
+def intern_strings(values):
+    # one shared, interned str object per distinct value
+    codes, uniques = pd.factorize(values)
+    uniques = np.array([sys.intern(x) for x in uniques], dtype=object)
+    return pd.Series(uniques[codes], index=values.index)
+
+def read_chrom_variants(f, columns, chrom_names):
+    # multithreaded pyarrow read of the rows of `chrom_names`, filtered a block at a time,
+    # and whether any row of the whole list has the chr prefix
+    string_columns = [x for x in ['chr', 'allele1', 'allele2', 'variant_id'] if x in columns]
+    reader = pyarrow.csv.open_csv(f,
+                                  read_options=pyarrow.csv.ReadOptions(column_names=columns),
+                                  parse_options=pyarrow.csv.ParseOptions(delimiter='\t'),
+                                  convert_options=pyarrow.csv.ConvertOptions(column_types=dict({x: pyarrow.string() for x in string_columns},
+                                                                                               pos=pyarrow.int32()),
+                                                                             strings_can_be_null=True))
+    has_chr_prefix = False
+    batches = []
+    for batch in reader:
+        chroms = batch.column('chr')
+        has_chr_prefix = has_chr_prefix or any('chr' in x.lower() for x in pyarrow.compute.unique(chroms).to_pylist() if x is not None)
+        batches.append(batch.filter(pyarrow.compute.is_in(chroms, value_set=pyarrow.array(chrom_names))))
+    variants_table = pyarrow.Table.from_batches(batches, schema=reader.schema).to_pandas()
+    variants_table['chr'] = variants_table['chr'].astype('category')
+    return variants_table, has_chr_prefix
+
+def load_variant_table(table_path, schema, chrom=None, chunk_size=1000000):
+    columns = get_variant_schema(schema)
+    # the alleles and ids are read as objects, since a str dtype turns the empty fields
+    # of the pyarrow engine into 'None' strings instead of the NaNs filled with "-" below
+    read_kwargs = dict(header=None, sep='\t', names=columns,
+                       dtype={'chr': 'category', 'pos': np.int32, 'allele1': object, 'allele2': object, 'variant_id': object})
+
+    with open_variant_list(table_path) as f:
+        if chrom is None:
+            variants_table = pd.read_csv(f, engine=CSV_ENGINE, **read_kwargs)
+            has_chr_prefix = any('chr' in str(x).lower() for x in variants_table['chr'].cat.categories)
+        else:
+            # keep only the rows of the requested chromosome while reading, with or without
+            # the chr prefix, which is added below if no row of the whole list has it
+            chrom_names = [chrom, chrom[3:]] if chrom.startswith('chr') else [chrom]
+            if CSV_ENGINE == 'pyarrow':
+                variants_table, has_chr_prefix = read_chrom_variants(f, columns, chrom_names)
+            else:
+                # without pyarrow, the C engine reads the list in chunks
+                has_chr_prefix = False
+                chunks = []
+                for chunk in pd.read_csv(f, chunksize=chunk_size, **read_kwargs):
+                    has_chr_prefix = has_chr_prefix or any('chr' in str(x).lower() for x in chunk['chr'].cat.categories)
+                    chunk = chunk.loc[chunk['chr'].isin(chrom_names)]
+                    chunk['chr'] = chunk['chr'].astype(str)
+                    chunks.append(chunk)
+                variants_table = pd.concat(chunks, ignore_index=True)
+                variants_table['chr'] = variants_table['chr'].astype('category')
     variants_table.drop(columns=[str(x) for x in variants_table.columns if str(x).startswith('ignore')], inplace=True)
-    variants_table['chr'] = variants_table['chr'].astype(str)
-    has_chr_prefix = any('chr' in x.lower() for x in variants_table['chr'].tolist())
+
     if not has_chr_prefix:
-        variants_table['chr'] = 'chr' + variants_table['chr']
+        variants_table['chr'] = variants_table['chr'].cat.rename_categories(['chr' + str(x) for x in variants_table['chr'].cat.categories])
+    if chrom is not None:
+        variants_table = variants_table.loc[variants_table['chr'] == chrom].reset_index(drop=True)
+        variants_table['chr'] = variants_table['chr'].cat.remove_unused_categories()
+
+    variants_table['variant_id'] = variants_table['variant_id'].fillna('-')
+    for column in ['allele1', 'allele2']:
+        variants_table[column] = intern_strings(variants_table[column].fillna('-'))
     if schema == "bed":
         variants_table['pos'] = variants_table['pos'] + 1
     return variants_table
@@ -357,6 +780,29 @@ def get_pvals(obs, bg, tail):
 def geo_mean_overflow(iterable,axis=0):
     return np.exp(np.log(iterable).mean(axis=0))
 
+MEAN_SCORES = ["logfc", "abs_logfc", "jsd", "logfc_x_jsd", "abs_logfc_x_jsd", "active_allele_quantile",
+               "logfc_x_active_allele_quantile", "abs_logfc_x_active_allele_quantile", "jsd_x_active_allele_quantile",
+               "logfc_x_jsd_x_active_allele_quantile", "abs_logfc_x_jsd_x_active_allele_quantile"]
+
+def get_mean_variant_scores(score_tables, id_columns):
+    # mean of each score across the score tables (folds or models) of the same variants,
+    # with the geometric mean of their p-values
+    variant_scores = score_tables[0][id_columns].copy()
+    for table in score_tables:
+        for column in ['chr', 'pos', 'allele1', 'allele2', 'variant_id']:
+            assert table[column].tolist() == variant_scores[column].tolist()
+
+    for score in MEAN_SCORES:
+        if score in score_tables[0]:
+            variant_scores.loc[:, (score + '.mean')] = np.mean(np.array([table[score].tolist()
+                                                                    for table in score_tables]), axis=0)
+            if score + '.pval' in score_tables[0]:
+                variant_scores.loc[:, (score + '.mean' + '.pval')] = geo_mean_overflow([table[score + '.pval'].values for table in score_tables])
+            elif score + '_pval' in score_tables[0]:
+                variant_scores.loc[:, (score + '.mean' + '.pval')] = geo_mean_overflow([table[score + '_pval'].values for table in score_tables])
+
+    return variant_scores
+
 def add_missing_columns_to_peaks_df(peaks, schema):
     if schema != 'narrowpeak':
         raise ValueError("Schema not supported")
@@ -0,0 +1,52 @@
+import numpy as np
+import tensorflow as tf
+
+# compiled inference engines of the loaded models, keyed by the id of the model
+INFERENCE_ENGINES = {}
+
+
+class InferenceEngine:
+    # runs a model through a tf.function traced once at load for a fixed, zero-padded batch shape, optionally compiled with XLA
+    def __init__(self, model, batch_size, lite=False, jit_compile=False):
+        self.model = model
+        self.batch_size = batch_size
+        self.lite = lite
+        self.input_len = model.input_shape[0][1] if lite else model.input_shape[1]
+        self.profile_len = model.output_shape[0][1]
+        self.input_buffer = np.zeros((batch_size, self.input_len, 4), dtype=np.int8)
+        self.__predict_fn = tf.function(self.__predict_batch,
+                                        input_signature=[tf.TensorSpec([batch_size, self.input_len, 4], tf.int8)],
+                                        jit_compile=jit_compile)
+        # trace (and compile) the graph once up front rather than on the first batch
+        self.__predict_fn(tf.constant(self.input_buffer))
+
+    def __predict_batch(self, seqs):
+        seqs = tf.cast(seqs, tf.float32)
+        if self.lite:
+            return self.model([seqs, tf.zeros([self.batch_size, self.profile_len]), tf.zeros([self.batch_size])], training=False)
+        return self.model(seqs, training=False)
+
+    def predict(self, seqs):
+        # returns [profiles, logcounts] of the sequences, as model.predict does
+        profiles = np.empty((len(seqs), self.profile_len), dtype=np.float32)
+        logcounts = np.empty((len(seqs), 1), dtype=np.float32)
+        for start in range(0, len(seqs), self.batch_size):
+            block = seqs[start:start + self.batch_size]
+            if len(block) < self.batch_size:
+                self.input_buffer[:len(block)] = block
+                self.input_buffer[len(block):] = 0
+                block = self.input_buffer
+            block_profiles, block_logcounts = self.__predict_fn(tf.constant(np.asarray(block, dtype=np.int8)))
+            num_seqs = min(self.batch_size, len(seqs) - start)
+            profiles[start:start + num_seqs] = block_profiles[:num_seqs]
+            logcounts[start:start + num_seqs] = block_logcounts[:num_seqs]
+        return [profiles, logcounts]
+
+
+def compile_inference_engine(model, batch_size, lite=False, jit_compile=False):
+    # builds and warms up the engine that predict_batches then uses for `model`
+    INFERENCE_ENGINES[id(model)] = InferenceEngine(model, batch_size, lite=lite, jit_compile=jit_compile)
+    return INFERENCE_ENGINES[id(model)]
+
+def get_inference_engine(model):
+    return INFERENCE_ENGINES.get(id(model))
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import hashlib
+import json
+import math
+import os
+
+
+class BatchJournal:
+    # journal of the finished batches of a prediction stage, with its predictions memory-mapped next to it;
+    # started over unless the table, batch size and settings match
+    def __init__(self, prefix, table, batch_size, settings, array_specs):
+        self.prefix = prefix
+        self.journal_file = prefix + ".journal"
+        self.num_batches = math.ceil(len(table) / batch_size)
+
+        fingerprint = hashlib.sha1(pd.util.hash_pandas_object(table, index=False).values.tobytes())
+        fingerprint.update(json.dumps(dict(settings,
+                                           batch_size=batch_size,
+                                           arrays={x: [list(y[0]), np.dtype(y[1]).str] for x, y in array_specs.items()}),
+                                      sort_keys=True).encode())
+        self.fingerprint = fingerprint.hexdigest()
+
+        self.done_batches = set()
+        resume = self.__load__(array_specs)
+        self.arrays = {}
+        for name, (shape, dtype) in array_specs.items():
+            self.arrays[name] = np.lib.format.open_memmap(self.__array_file__(name), mode='r+' if resume else 'w+',
+                                                          dtype=dtype, shape=shape)
+        if not resume:
+            with open(self.journal_file, 'w') as f:
+                f.write(json.dumps({'fingerprint': self.fingerprint, 'num_batches': self.num_batches}) + "\n")
+        self.journal = open(self.journal_file, 'a')
+
+        if self.done_batches:
+            print("Resuming from %s with %d of %d batches finished" % (self.journal_file, len(self.done_batches), self.num_batches))
+
+    def __array_file__(self, name):
+        return '.'.join([self.prefix, name, "npy"])
+
+    def __load__(self, array_specs):
+        if not os.path.isfile(self.journal_file):
+            return False
+        if not all(os.path.isfile(self.__array_file__(x)) for x in array_specs):
+            return False
+        with open(self.journal_file) as f:
+            lines = f.read().splitlines()
+        try:
+            if not lines or json.loads(lines[0]).get('fingerprint') != self.fingerprint:
+                return False
+        except ValueError:
+            return False
+        for line in lines[1:]:
+            # a line cut off by the crash ends the finished batches
+            try:
+                self.done_batches.add(json.loads(line)['batch'])
+            except (ValueError, KeyError):
+                break
+        return True
+
+    def remaining_batches(self):
+        return [x for x in range(self.num_batches) if x not in self.done_batches]
+
+    def mark_done(self, batch_idx):
+        for array in self.arrays.values():
+            array.flush()
+        self.journal.write(json.dumps({'batch': int(batch_idx)}) + "\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.done_batches.add(batch_idx)
+
+    def close(self):
+        self.journal.close()
+        self.arrays = {}
+
+def remove_journal(prefix):
+    # the journal and its arrays are only needed until the run's outputs are written
+    prefix_dir = os.path.dirname(prefix) or '.'
+    prefix_name = os.path.basename(prefix)
+    for x in os.listdir(prefix_dir):
+        if x == prefix_name + ".journal" or (x.startswith(prefix_name + ".") and x.endswith(".npy")):
+            os.remove(os.path.join(prefix_dir, x))
@@ -0,0 +1,89 @@
+import pandas as pd
+import datetime
+import hashlib
+import json
+import os
+import pyfaidx
+from utils.genome import is_genome_cache, GENOME_CACHE_INDEX
+
+NULL_BANK_SCORES = "shuffled_scores.tsv"
+NULL_BANK_MANIFEST = "manifest.json"
+
+# manifest fields that must match the current run for a null bank to be used
+NULL_BANK_MATCH_FIELDS = ['model_sha1', 'lite', 'forward_only', 'genome_sha1', 'peaks_sha1', 'peak_genome_sha1',
+                          'max_peaks', 'peak_sample_seed']
+
+
+def get_file_sha1(path, block_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def get_genome_sha1(genome_path):
+    # fingerprint of the chromosomes of a genome, from the .fai index of a FASTA file or the index of a genome cache
+    if is_genome_cache(genome_path):
+        return get_file_sha1(os.path.join(genome_path, GENOME_CACHE_INDEX))
+    if not os.path.isfile(genome_path + '.fai'):
+        pyfaidx.Faidx(genome_path)
+    return get_file_sha1(genome_path + '.fai')
+
+def get_null_bank_dir(model_file):
+    # the default null bank of a model sits next to the model file
+    return model_file + ".null_bank"
+
+def get_null_bank_provenance(model_file, args):
+    # the fingerprints and modes a null bank must have been built with to be reused, plus the inputs it was sampled from
+    peak_genome = args.peak_genome if args.peak_genome else args.genome
+    return {'model': os.path.abspath(model_file),
+            'model_sha1': get_file_sha1(model_file),
+            'lite': args.lite,
+            'forward_only': args.forward_only,
+            'genome': os.path.abspath(args.genome),
+            'genome_sha1': get_genome_sha1(args.genome),
+            'peaks': os.path.abspath(args.peaks) if args.peaks else None,
+            'peaks_sha1': get_file_sha1(args.peaks) if args.peaks else None,
+            'peak_genome_sha1': get_genome_sha1(peak_genome) if args.peaks else None,
+            'max_peaks': args.max_peaks if args.peaks else None,
+            # the peaks are subsampled with the random seed
+            'peak_sample_seed': args.random_seed if args.peaks and args.max_peaks else None,
+            'variant_list': os.path.abspath(args.list),
+            'schema': args.schema,
+            'random_seed': args.random_seed}
+
+def load_null_bank(bank_dir, provenance):
+    # the scored shuffled variants of the bank, or None if there is none or its provenance does not match
+    manifest_file = os.path.join(bank_dir, NULL_BANK_MANIFEST)
+    if not os.path.isfile(manifest_file):
+        return None
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+
+    mismatched = [x for x in NULL_BANK_MATCH_FIELDS if manifest.get(x) != provenance[x]]
+    if mismatched:
+        print("Not using the null bank in %s, built with a different %s" % (bank_dir, ', '.join(mismatched)))
+        return None
+
+    # exact floats in their original dtypes keep ties between the scores the same as when the bank was built
+    shuf_variants_table = pd.read_table(os.path.join(bank_dir, NULL_BANK_SCORES), float_precision='round_trip')
+    shuf_variants_table = shuf_variants_table.astype({x: y for x, y in manifest['float_dtypes'].items() if x in shuf_variants_table})
+    assert len(shuf_variants_table) == manifest['num_shuffled_variants']
+    print("Using the null bank in %s, built on %s with %d shuffled variants" % (bank_dir, manifest['created'], len(shuf_variants_table)))
+    return shuf_variants_table
+
+def write_null_bank(bank_dir, shuf_variants_table, provenance, target_size):
+    os.makedirs(bank_dir, exist_ok=True)
+    manifest_file = os.path.join(bank_dir, NULL_BANK_MANIFEST)
+    if os.path.isfile(manifest_file):
+        os.remove(manifest_file)
+    shuf_variants_table.to_csv(os.path.join(bank_dir, NULL_BANK_SCORES), sep="\t", index=False)
+    # the manifest is written last, so a bank interrupted while writing is never picked up
+    manifest = dict(provenance,
+                    target_size=target_size,
+                    num_shuffled_variants=len(shuf_variants_table),
+                    float_dtypes={x: str(y) for x, y in shuf_variants_table.dtypes.items() if y.kind == 'f'},
+                    created=datetime.datetime.now().isoformat(timespec='seconds'))
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    print("Wrote the null bank of %d shuffled variants to %s" % (len(shuf_variants_table), bank_dir))
@@ -0,0 +1,50 @@
+import numpy as np
+
+# the scores tested against the shuffled null, with the tail of each test
+NULL_SCORE_TAILS = [("logfc", "both"), ("abs_logfc", "right"), ("jsd", "right"),
+                    ("logfc_x_jsd", "both"), ("abs_logfc_x_jsd", "right"),
+                    ("active_allele_quantile", "right"), ("quantile_change", "both"),
+                    ("abs_quantile_change", "right"), ("logfc_x_active_allele_quantile", "both"),
+                    ("abs_logfc_x_active_allele_quantile", "right"), ("jsd_x_active_allele_quantile", "right"),
+                    ("logfc_x_jsd_x_active_allele_quantile", "both"), ("abs_logfc_x_jsd_x_active_allele_quantile", "right")]
+
+
+class NullDistribution:
+    # shuffled scores with each column sorted once, or memory-mapped from <memmap_prefix>.<score>.npy, so p-values are binary searches
+    def __init__(self, shuf_variants_table, memmap_prefix=None):
+        self.num_shuffled = len(shuf_variants_table)
+        self.sorted_scores = {}
+        for score, tail in NULL_SCORE_TAILS:
+            if score not in shuf_variants_table:
+                continue
+            sorted_bg = np.sort(shuf_variants_table[score].values)
+            if memmap_prefix is not None:
+                sorted_file = '.'.join([memmap_prefix, score, "npy"])
+                np.save(sorted_file, sorted_bg)
+                sorted_bg = np.load(sorted_file, mmap_mode='r')
+            self.sorted_scores[score] = sorted_bg
+
+    def get_pvals(self, scores_table, scores=None):
+        # p-values of each of `scores` (default all), with the tails of NULL_SCORE_TAILS
+        if scores is None:
+            scores = list(self.sorted_scores)
+        for score in scores:
+            if score not in self.sorted_scores:
+                raise ValueError("The shuffled null has no %s scores" % score)
+
+        pvals = {}
+        for score, tail in NULL_SCORE_TAILS:
+            if score not in scores:
+                continue
+            obs = np.asarray(scores_table[score])
+            sorted_bg = self.sorted_scores[score]
+            pval_right = (len(sorted_bg) - np.searchsorted(sorted_bg, obs, side='left') + 1) / (len(sorted_bg) + 1)
+            if tail == 'right':
+                pvals[score] = pval_right
+                continue
+            pval_left = (np.searchsorted(sorted_bg, obs, side='right') + 1) / (len(sorted_bg) + 1)
+            if tail == 'left':
+                pvals[score] = pval_left
+            else:
+                pvals[score] = np.minimum(pval_left, pval_right) * 2
+        return pvals
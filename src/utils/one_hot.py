@@ -37,6 +37,39 @@ def dna_to_one_hot(seqs):
     return one_hot_map[base_inds[:-4]].reshape((len(seqs), seq_len, 4))
 
 
+# 256-entry lookup table from ASCII codes to one-hot rows ordered "ACGT";
+# lower-case bases share the upper-case rows, anything else is all 0s
+ONE_HOT_TABLE = np.zeros((256, 4), dtype=np.int8)
+for i, base in enumerate("ACGT"):
+    ONE_HOT_TABLE[ord(base), i] = 1
+    ONE_HOT_TABLE[ord(base.lower()), i] = 1
+
+
+def dna_to_one_hot_lut(seqs, out=None):
+    """
+    Converts DNA sequences to one-hot encodings with a single lookup into
+    `ONE_HOT_TABLE`, giving the same encodings as `dna_to_one_hot` without
+    sorting the batch. `seqs` is either an N x L uint8 array of ASCII codes
+    or a list of N strings that are all of length L. If `out` is given, it
+    must be an N x L x 4 array; it is filled in place and returned, so one
+    buffer can be reused across batches. Otherwise a new int8 array is
+    returned.
+    """
+    if isinstance(seqs, np.ndarray):
+        assert seqs.dtype == np.uint8 and seqs.ndim == 2
+        codes = seqs
+    else:
+        seq_len = len(seqs[0])
+        assert np.all(np.array([len(s) for s in seqs]) == seq_len)
+        codes = np.frombuffer("".join(seqs).encode("ascii"), dtype=np.uint8).reshape((len(seqs), seq_len))
+
+    if out is None:
+        out = np.empty(codes.shape + (4,), dtype=np.int8)
+    assert out.shape == codes.shape + (4,)
+    np.take(ONE_HOT_TABLE.astype(out.dtype, copy=False), codes, axis=0, out=out, mode='clip')
+    return out
+
+
 def one_hot_to_dna(one_hot):
     """
     Converts a one-hot encoding into a list of DNA ("ACGT") sequences, where the
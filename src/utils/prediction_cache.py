@@ -0,0 +1,106 @@
+import numpy as np
+import hashlib
+import sqlite3
+import time
+
+# sqlite limits the number of parameters in one statement
+MAX_QUERY_KEYS = 500
+
+# weight fingerprints of the models loaded in this process
+MODEL_FINGERPRINTS = {}
+
+
+def get_model_fingerprint(model):
+    # SHA-1 of the model's weights, computed once per loaded model
+    if id(model) not in MODEL_FINGERPRINTS:
+        fingerprint = hashlib.sha1()
+        for weights in model.get_weights():
+            fingerprint.update(str(weights.shape).encode())
+            fingerprint.update(np.ascontiguousarray(weights).tobytes())
+        MODEL_FINGERPRINTS[id(model)] = fingerprint.digest()
+    return MODEL_FINGERPRINTS[id(model)]
+
+
+class PredictionCache:
+    # sqlite cache of float32 predictions keyed by the model weights, strand mode and input window,
+    # which evicts the least recently used entries once it grows past max_size_gb
+    def __init__(self, path, max_size_gb=10.0):
+        self.path = path
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        self.__connect__()
+
+    def __connect__(self):
+        self.conn = sqlite3.connect(self.path, timeout=600)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS predictions "
+                          "(key BLOB PRIMARY KEY, counts REAL, profile BLOB, size INTEGER, last_used REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)")
+        self.conn.commit()
+        self.size = self.__get_size__()
+
+    def __get_size__(self):
+        return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM predictions").fetchone()[0]
+
+    # the connection is reopened by each worker process the cache is sent to
+    def __getstate__(self):
+        return {'path': self.path, 'max_size': self.max_size}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__connect__()
+
+    def get_keys(self, model, seqs, forward_only=False):
+        # one-hot windows are packed to one bit per base and channel before hashing
+        prefix = get_model_fingerprint(model) + (b'f' if forward_only else b'b')
+        packed_seqs = np.packbits(seqs.reshape(len(seqs), -1) != 0, axis=1)
+        return [hashlib.sha1(prefix + x.tobytes()).digest() for x in packed_seqs]
+
+    def lookup(self, keys):
+        # the cached (counts, profile) of each key found, marked as used
+        found = {}
+        unique_keys = list(set(keys))
+        for i in range(0, len(unique_keys), MAX_QUERY_KEYS):
+            query_keys = unique_keys[i:i + MAX_QUERY_KEYS]
+            rows = self.conn.execute("SELECT key, counts, profile FROM predictions WHERE key IN (%s)" %
+                                     ','.join('?' * len(query_keys)), query_keys).fetchall()
+            for key, counts, profile in rows:
+                found[key] = (counts, np.frombuffer(profile, dtype=np.float32))
+        if found:
+            now = time.time()
+            self.conn.executemany("UPDATE predictions SET last_used = ? WHERE key = ?", [(now, x) for x in found])
+            self.conn.commit()
+        return found
+
+    def insert(self, keys, counts, profiles):
+        now = time.time()
+        profiles = profiles.astype(np.float32, copy=False)
+        rows = [(key, float(count), profile.tobytes(), profile.nbytes + len(key) + 8, now)
+                for key, count, profile in zip(keys, counts.reshape(-1), profiles)]
+        self.conn.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)", rows)
+        self.conn.commit()
+        # the running size is an estimate, since other processes may share the cache,
+        # so the exact size is only summed up once the estimate passes the bound
+        self.size += sum(x[3] for x in rows)
+        if self.size > self.max_size:
+            self.__evict__()
+
+    def __evict__(self):
+        size = self.__get_size__()
+        target = int(self.max_size * 0.9)
+        while size > target:
+            rows = self.conn.execute("SELECT key, size FROM predictions ORDER BY last_used LIMIT ?",
+                                     (MAX_QUERY_KEYS,)).fetchall()
+            if not rows:
+                break
+            evicted = []
+            for key, row_size in rows:
+                if size <= target:
+                    break
+                evicted.append((key,))
+                size -= row_size
+            self.conn.executemany("DELETE FROM predictions WHERE key = ?", evicted)
+            self.conn.commit()
+        self.size = size
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,110 @@
+import numpy as np
+import h5py
+from utils.helpers import softmax_with_log_normalizers
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+# codecs of the hdf5 predictions; lz4 and zstd are hdf5plugin filters,
+# which are also needed to read the files back
+HDF5_COMPRESSIONS = ['gzip-9', 'gzip-1', 'lz4', 'zstd', 'none']
+
+PREDICTION_DATASETS = ['allele1_pred_counts', 'allele2_pred_counts', 'allele1_pred_profiles', 'allele2_pred_profiles']
+
+# per-variant summaries of the full-length profiles, with positions in bp from the variant
+PROFILE_SUMMARY_DATASETS = [('allele1_profile_argmax', np.int32), ('allele2_profile_argmax', np.int32),
+                            ('profile_max_abs_delta', np.float32), ('profile_max_abs_delta_pos', np.int32)]
+
+
+def get_hdf5_compression(compression):
+    # create_dataset keyword arguments of each codec
+    if compression not in HDF5_COMPRESSIONS:
+        raise ValueError("Unknown hdf5 compression %s, expected one of %s" % (compression, ', '.join(HDF5_COMPRESSIONS)))
+    if compression == 'none':
+        return {}
+    if compression.startswith('gzip-'):
+        return {'compression': 'gzip', 'compression_opts': int(compression[len('gzip-'):])}
+    if hdf5plugin is None:
+        raise ValueError("%s compression of the hdf5 predictions needs hdf5plugin" % compression)
+    if compression == 'lz4':
+        return dict(hdf5plugin.LZ4())
+    return dict(hdf5plugin.Zstd())
+
+def get_profile_window(profile_len, profile_window=None):
+    # start and end of the central `profile_window` bp of the profiles, all of them by default
+    if profile_window is None:
+        return 0, profile_len
+    if profile_window < 0 or profile_window > profile_len:
+        raise ValueError("--profile_window must be between 0 and the profile length of %d" % profile_len)
+    start = (profile_len - profile_window) // 2
+    return start, start + profile_window
+
+def get_profile_summary(allele1_pred_profiles, allele2_pred_profiles):
+    # PROFILE_SUMMARY_DATASETS of each variant, with positions relative to the profile centre
+    center = allele1_pred_profiles.shape[1] // 2
+    allele1_probs, _ = softmax_with_log_normalizers(np.asarray(allele1_pred_profiles, dtype=np.float32))
+    allele2_probs, _ = softmax_with_log_normalizers(np.asarray(allele2_pred_profiles, dtype=np.float32))
+    abs_delta = np.abs(allele2_probs - allele1_probs)
+    max_abs_delta_pos = np.argmax(abs_delta, axis=1)
+    return {'allele1_profile_argmax': np.argmax(allele1_probs, axis=1) - center,
+            'allele2_profile_argmax': np.argmax(allele2_probs, axis=1) - center,
+            'profile_max_abs_delta': abs_delta[np.arange(len(abs_delta)), max_abs_delta_pos],
+            'profile_max_abs_delta_pos': max_abs_delta_pos - center}
+
+
+class PredictionWriter:
+    # writes predictions as they arrive into hdf5 datasets preallocated and chunked by chunk_size rows,
+    # with the profiles cropped to profile_window and summarized with profile_summary
+    def __init__(self, path, variant_ids, profile_len, profile_dtype=np.float32, compression='gzip-9', chunk_size=512,
+                 profile_window=None, profile_summary=False):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.profile_summary = profile_summary
+        self.profile_start, self.profile_end = get_profile_window(profile_len, profile_window)
+        num_variants = len(variant_ids)
+        compression_kwargs = get_hdf5_compression(compression)
+
+        self.file = h5py.File(path, 'w')
+        observed = self.file.create_group('observed')
+        observed.attrs['profile_len'] = profile_len
+        observed.attrs['profile_start'] = self.profile_start
+        encoded_ids = np.char.encode(np.asarray(variant_ids, dtype=str), 'utf-8') if num_variants > 0 else np.zeros(0, dtype='S1')
+        observed.create_dataset('variant_id', data=encoded_ids, chunks=(max(min(num_variants, chunk_size), 1),), **compression_kwargs)
+
+        dataset_specs = [('allele1_pred_counts', (1,), np.float32), ('allele2_pred_counts', (1,), np.float32)]
+        if self.profile_end > self.profile_start:
+            dataset_specs += [('allele1_pred_profiles', (self.profile_end - self.profile_start,), profile_dtype),
+                              ('allele2_pred_profiles', (self.profile_end - self.profile_start,), profile_dtype)]
+        if profile_summary:
+            dataset_specs += [(name, (), dtype) for name, dtype in PROFILE_SUMMARY_DATASETS]
+
+        self.datasets = {}
+        for name, shape, dtype in dataset_specs:
+            self.datasets[name] = observed.create_dataset(name, shape=(num_variants,) + shape, dtype=dtype,
+                                                          chunks=(max(min(num_variants, chunk_size), 1),) + shape,
+                                                          **compression_kwargs)
+
+    def write(self, start, allele1_pred_counts, allele2_pred_counts, allele1_pred_profiles, allele2_pred_profiles):
+        # writes the predictions of the variants from row `start` on, cropping and
+        # summarizing the full-length profiles a chunk at a time
+        for chunk_start in range(0, len(allele1_pred_counts), self.chunk_size):
+            chunk = slice(chunk_start, chunk_start + self.chunk_size)
+            arrays = {'allele1_pred_counts': allele1_pred_counts[chunk],
+                      'allele2_pred_counts': allele2_pred_counts[chunk]}
+            # without stored profiles or summaries, the profiles can be left out
+            if 'allele1_pred_profiles' in self.datasets:
+                arrays['allele1_pred_profiles'] = allele1_pred_profiles[chunk, self.profile_start:self.profile_end]
+                arrays['allele2_pred_profiles'] = allele2_pred_profiles[chunk, self.profile_start:self.profile_end]
+            if self.profile_summary:
+                arrays.update(get_profile_summary(allele1_pred_profiles[chunk], allele2_pred_profiles[chunk]))
+            self.write_datasets(start + chunk_start, arrays)
+
+    def write_datasets(self, start, arrays):
+        # writes already cropped and summarized arrays into the datasets this file has
+        for name, dataset in self.datasets.items():
+            dataset[start:start + len(arrays[name])] = arrays[name]
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,63 @@
+import numpy as np
+import tensorflow as tf
+
+
+class VariantScoringHead:
+    # predicts and scores both alleles (and strands) of a batch in one graph, so only per-variant values leave TensorFlow
+    def __init__(self, model, lite=False, forward_only=False):
+        self.model = model
+        self.lite = lite
+        self.forward_only = forward_only
+        self.profile_len = model.output_shape[0][1]
+        # retraced once for each value of return_profiles, and once for the last, shorter batch
+        self.__score_fn = tf.function(self.__score_batch, reduce_retracing=True)
+
+    def __call__(self, allele1_seqs, allele2_seqs, return_profiles=False):
+        # counts, logfc and jsd of a batch as numpy arrays, with the profile logits if return_profiles is set
+        outputs = self.__score_fn(tf.convert_to_tensor(allele1_seqs), tf.convert_to_tensor(allele2_seqs),
+                                  return_profiles)
+        return {name: x.numpy() for name, x in outputs.items()}
+
+    def __predict(self, seqs):
+        if self.lite:
+            num_seqs = tf.shape(seqs)[0]
+            return self.model([seqs, tf.zeros([num_seqs, self.profile_len]), tf.zeros([num_seqs])], training=False)
+        return self.model(seqs, training=False)
+
+    def __score_batch(self, allele1_seqs, allele2_seqs, return_profiles):
+        num_variants = tf.shape(allele1_seqs)[0]
+        seqs = tf.cast(tf.concat([allele1_seqs, allele2_seqs], axis=0), tf.float32)
+        if not self.forward_only:
+            seqs = tf.concat([seqs, tf.reverse(seqs, axis=[1, 2])], axis=0)
+        profiles, logcounts = self.__predict(seqs)
+        counts = tf.exp(logcounts)
+
+        if not self.forward_only:
+            # the reverse complement profiles are flipped back to the forward orientation
+            num_seqs = 2 * num_variants
+            counts = (counts[:num_seqs] + counts[num_seqs:]) / 2
+            profiles = (profiles[:num_seqs] + tf.reverse(profiles[num_seqs:], axis=[1])) / 2
+
+        allele1_counts, allele2_counts = counts[:num_variants], counts[num_variants:]
+        allele1_profiles, allele2_profiles = profiles[:num_variants], profiles[num_variants:]
+        outputs = {'allele1_pred_counts': allele1_counts,
+                   'allele2_pred_counts': allele2_counts,
+                   'logfc': tf.squeeze(tf.math.log(allele2_counts / allele1_counts), axis=1) / np.log(2).astype(np.float32),
+                   'jsd': jensenshannon_distance(allele2_profiles, allele1_profiles)}
+        if return_profiles:
+            outputs['allele1_pred_profiles'] = allele1_profiles
+            outputs['allele2_pred_profiles'] = allele2_profiles
+        return outputs
+
+
+def jensenshannon_distance(logits1, logits2):
+    # the TensorFlow version of helpers.jensenshannon_distance, in the same
+    # float32 log space, with the sum over each row taken in float64
+    max_d = 80.0
+    log_p = tf.nn.log_softmax(logits1, axis=1)
+    log_q = tf.nn.log_softmax(logits2, axis=1)
+    d = log_q - log_p
+    log_p_m = -(tf.math.log1p(tf.math.expm1(tf.minimum(d, max_d)) / 2) + tf.maximum(d - max_d, 0))
+    p, q = tf.exp(log_p), tf.exp(log_q)
+    js = tf.reduce_sum(tf.cast((p + q) * log_p_m + q * d, tf.float64), axis=1) / (2 * np.log(2))
+    return tf.sqrt(tf.maximum(js, 0))
@@ -0,0 +1,158 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory, resource_tracker
+import copy
+import multiprocessing
+import numpy as np
+import math
+import os
+
+# each worker process loads the models once and keeps them for all of its shards
+worker_state = {}
+
+
+def init_worker(model_files, intra_op_threads, inter_op_threads, cpu_sets, inference_engine_kwargs):
+    import tensorflow as tf
+    from utils.helpers import load_model_wrapper
+    from utils.inference_engine import compile_inference_engine
+
+    if cpu_sets is not None:
+        os.sched_setaffinity(0, cpu_sets.get())
+    if intra_op_threads > 0:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    if inter_op_threads > 0:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    worker_state['models'] = [load_model_wrapper(x) for x in model_files]
+    if inference_engine_kwargs is not None:
+        for model in worker_state['models']:
+            compile_inference_engine(model, **inference_engine_kwargs)
+
+def predict_shard(fetch_name, table, shard_start, outputs, model_indices, fetch_kwargs):
+    from utils import helpers
+
+    models = [worker_state['models'][i] for i in model_indices]
+    results = getattr(helpers, fetch_name)(models, table, **fetch_kwargs)
+    ids, arrays = results[0], [array for model_arrays in results[1:] for array in model_arrays]
+    for (shm_name, shape, dtype), array in zip(outputs, arrays):
+        shm = shared_memory.SharedMemory(name=shm_name)
+        # the parent owns and unlinks the block, the worker only attaches to it
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        out = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        out[shard_start:shard_start + len(array)] = array
+        del out
+        shm.close()
+    return ids
+
+
+class ShardedPredictor:
+    # predicts batch-aligned shards of a table in worker processes, which load the models once, into shared memory
+    def __init__(self,
+                 model_files,
+                 num_workers,
+                 intra_op_threads=0,
+                 inter_op_threads=0,
+                 pin_cpus=False,
+                 shards_per_worker=4,
+                 inference_engine_kwargs=None):
+
+        self.num_workers = num_workers
+        self.shards_per_worker = shards_per_worker
+        context = multiprocessing.get_context('spawn')
+
+        cpu_sets = None
+        if pin_cpus:
+            cpus = sorted(os.sched_getaffinity(0))
+            if len(cpus) < num_workers:
+                raise ValueError("Cannot pin %d workers to %d available cores" % (num_workers, len(cpus)))
+            cpu_sets = context.Queue()
+            for core_set in np.array_split(cpus, num_workers):
+                cpu_sets.put([int(x) for x in core_set])
+
+        self.executor = ProcessPoolExecutor(max_workers=num_workers,
+                                            mp_context=context,
+                                            initializer=init_worker,
+                                            initargs=(list(model_files), intra_op_threads, inter_op_threads, cpu_sets, inference_engine_kwargs))
+        self.model_indices = list(range(len(model_files)))
+
+    def for_models(self, model_indices):
+        subset = copy.copy(self)
+        subset.model_indices = list(model_indices)
+        return subset
+
+    def __submit__(self, fetch_name, table, batch_size, output_specs, fetch_kwargs, num_shards):
+        num_rows = len(table)
+        num_batches = math.ceil(num_rows / batch_size)
+        num_shards = min(num_batches, num_shards)
+        shard_starts = [int(x) * batch_size for x in np.linspace(0, num_batches, num_shards + 1)]
+
+        blocks = []
+        try:
+            outputs = []
+            for shape, dtype in output_specs:
+                shape = (num_rows,) + shape
+                blocks.append(shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)))
+                outputs.append((blocks[-1].name, shape, dtype))
+
+            futures = [self.executor.submit(predict_shard, fetch_name, table.iloc[start:end], start, outputs, self.model_indices,
+                                            dict(fetch_kwargs, batch_size=batch_size))
+                       for start, end in zip(shard_starts[:-1], shard_starts[1:]) if end > start]
+        except Exception:
+            self.__release__(blocks)
+            raise
+        return futures, blocks, outputs
+
+    def __collect__(self, futures, blocks, outputs):
+        try:
+            ids = [x for future in futures for x in future.result()]
+            arrays = [np.ndarray(shape, dtype=dtype, buffer=block.buf).copy()
+                      for block, (name, shape, dtype) in zip(blocks, outputs)]
+        finally:
+            self.__release__(blocks)
+
+        # regroup the flat list of arrays into one list per prediction output
+        return (np.array(ids),) + tuple(arrays[i:i + len(self.model_indices)] for i in range(0, len(arrays), len(self.model_indices)))
+
+    def __release__(self, blocks):
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    def __predict__(self, fetch_name, table, batch_size, output_specs, fetch_kwargs):
+        return self.__collect__(*self.__submit__(fetch_name, table, batch_size, output_specs, fetch_kwargs,
+                                                 self.num_workers * self.shards_per_worker))
+
+    def fetch_peak_predictions(self, peaks, batch_size, profile_lens, profile_dtype=np.float32, **fetch_kwargs):
+        return self.__predict__('fetch_peak_predictions', peaks, batch_size,
+                                [((1,), np.float32)] * len(self.model_indices) +
+                                [((x,), profile_dtype) for x in profile_lens],
+                                dict(fetch_kwargs, profile_dtype=profile_dtype))
+
+    def fetch_variant_predictions(self, variants_table, batch_size, profile_lens, profile_dtype=np.float32, **fetch_kwargs):
+        return self.__predict__('fetch_variant_predictions', variants_table, batch_size,
+                                [((1,), np.float32)] * (2 * len(self.model_indices)) +
+                                [((x,), profile_dtype) for x in profile_lens] * 2,
+                                dict(fetch_kwargs, profile_dtype=profile_dtype))
+
+    def iter_table_variant_predictions(self, variants_tables, batch_size, profile_lens, profile_dtype=np.float32, **fetch_kwargs):
+        # predicts each table whole in one worker and yields (table index, predictions) as tables finish
+        output_specs = [((1,), np.float32)] * (2 * len(self.model_indices)) + [((x,), profile_dtype) for x in profile_lens] * 2
+        fetch_kwargs = dict(fetch_kwargs, profile_dtype=profile_dtype)
+        todo = [i for i, x in enumerate(variants_tables) if len(x) > 0]
+        pending = {}
+        try:
+            while todo or pending:
+                while todo and len(pending) < self.num_workers:
+                    i = todo.pop(0)
+                    futures, blocks, outputs = self.__submit__('fetch_variant_predictions', variants_tables[i], batch_size,
+                                                               output_specs, fetch_kwargs, 1)
+                    pending[futures[0]] = (i, blocks, outputs)
+                done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i, blocks, outputs = pending.pop(future)
+                    yield (i,) + self.__collect__([future], blocks, outputs)
+        finally:
+            for future, (i, blocks, outputs) in pending.items():
+                future.cancel()
+                self.__release__(blocks)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,105 @@
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# score tables are written as TSV, or as zstd-compressed columnar files in
+# row groups (parquet) or record batches (feather) of TABLE_ROW_GROUP_SIZE rows
+TABLE_FORMATS = ['tsv', 'parquet', 'feather']
+TABLE_ROW_GROUP_SIZE = 65536
+TABLE_COMPRESSION = 'zstd'
+
+
+def check_table_format(table_format):
+    if table_format not in TABLE_FORMATS:
+        raise ValueError("Unknown table format %s, expected one of %s" % (table_format, ', '.join(TABLE_FORMATS)))
+    if table_format != 'tsv' and pyarrow is None:
+        raise ValueError("Writing %s tables needs pyarrow" % table_format)
+
+def get_table_file(prefix, table_format):
+    return '.'.join([prefix, table_format])
+
+def get_table_format(path):
+    # columnar tables are recognized by their extension, anything else is read as TSV
+    for table_format in TABLE_FORMATS[1:]:
+        if str(path).endswith('.' + table_format):
+            return table_format
+    return 'tsv'
+
+def get_table_columns(path):
+    # the column names, read from the file's schema or header only
+    table_format = get_table_format(path)
+    if table_format == 'parquet':
+        return pyarrow.parquet.read_schema(path).names
+    if table_format == 'feather':
+        return pyarrow.ipc.open_file(path).schema.names
+    return pd.read_table(path, nrows=0).columns.tolist()
+
+def read_score_table(path, columns=None, **read_kwargs):
+    # `columns` (default all) of a score table in the format of its extension; read_kwargs only apply to TSV
+    table_format = get_table_format(path)
+    if table_format == 'parquet':
+        return pd.read_parquet(path, columns=columns)
+    if table_format == 'feather':
+        return pd.read_feather(path, columns=columns)
+    return pd.read_table(path, usecols=columns, **read_kwargs)
+
+def iter_score_table_batches(path, batch_size=TABLE_ROW_GROUP_SIZE):
+    # yields the rows of a score table as data frames of up to `batch_size` rows
+    table_format = get_table_format(path)
+    if table_format == 'parquet':
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=batch_size):
+            yield batch.to_pandas()
+    elif table_format == 'feather':
+        reader = pyarrow.ipc.open_file(path)
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i).to_pandas()
+    else:
+        for batch in pd.read_table(path, chunksize=batch_size):
+            yield batch
+
+def write_score_table(table, path):
+    writer = ScoreTableWriter(path)
+    writer.write(table)
+    writer.close()
+
+
+class ScoreTableWriter:
+    # appends batches of rows to a TSV, parquet or feather table, as given by the extension of path
+    def __init__(self, path):
+        self.path = path
+        self.table_format = get_table_format(path)
+        self.writer = None
+        self.started = False
+        self.num_rows = 0
+
+    def write(self, table):
+        if self.table_format == 'tsv':
+            table.to_csv(self.path, sep="\t", index=False, mode='a' if self.started else 'w', header=not self.started)
+        else:
+            # the categories of categorical columns can differ between batches,
+            # which an Arrow file cannot hold, so their values are written as is
+            categorical = [x for x in table.columns if isinstance(table[x].dtype, pd.CategoricalDtype)]
+            if categorical:
+                table = table.astype({x: object for x in categorical})
+            batch = pyarrow.Table.from_pandas(table, preserve_index=False)
+            if self.writer is None:
+                if self.table_format == 'parquet':
+                    self.writer = pyarrow.parquet.ParquetWriter(self.path, batch.schema, compression=TABLE_COMPRESSION)
+                else:
+                    self.writer = pyarrow.ipc.new_file(self.path, batch.schema,
+                                                       options=pyarrow.ipc.IpcWriteOptions(compression=TABLE_COMPRESSION))
+            if self.table_format == 'parquet':
+                self.writer.write_table(batch, row_group_size=TABLE_ROW_GROUP_SIZE)
+            else:
+                self.writer.write_table(batch, max_chunksize=TABLE_ROW_GROUP_SIZE)
+        self.started = True
+        self.num_rows += len(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
@@ -2,6 +2,7 @@ import pandas as pd
 import pybedtools
 from utils.argmanager import *
 from utils.helpers import *
+from utils.table_io import *
 pd.set_option('display.max_columns', 20)
 
 
@@ -13,7 +14,8 @@ def main():
     peak_path = args.peaks
     genes = args.genes
 
-    variant_scores = pd.read_table(variant_scores_file)
+    check_table_format(args.output_format)
+    variant_scores = read_score_table(variant_scores_file)
 
     if args.schema == "bed":
         if variant_scores['pos'].equals(variant_scores['end']):
@@ -95,8 +97,8 @@ def main():
     print("Annotation table shape:", variant_scores.shape)
     print()
 
-    out_file = output_prefix + ".annotations.tsv"
-    variant_scores.to_csv(out_file, sep="\t", index=False)
+    out_file = get_table_file(output_prefix + ".annotations", args.output_format)
+    write_score_table(variant_scores, out_file)
 
     print("DONE")
     print()
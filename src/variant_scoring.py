@@ -1,9 +1,16 @@
 import pandas as pd
 import os
 import numpy as np
-import h5py
 from utils import argmanager
 from utils.helpers import *
+from utils.sharding import ShardedPredictor
+from utils.prediction_cache import PredictionCache
+from utils.null_bank import *
+from utils.journal import remove_journal
+from utils.chrom_merge import *
+from utils.table_io import *
+from utils.inference_engine import compile_inference_engine
+from utils.prediction_writer import PredictionWriter, get_hdf5_compression, get_profile_window
 
 
 def main():
@@ -18,19 +25,72 @@ def main():
     if not os.path.exists(out_dir):
         raise OSError("Output directory does not exist")
 
-    # load the model and variants
-    model = load_model_wrapper(args.model)
-    variants_table = load_variant_table(args.list, args.schema)
-    variants_table = variants_table.fillna('-')
+    if args.workers > 0 and args.streaming:
+        raise ValueError("--workers cannot be combined with --streaming, which scores each batch as it is predicted")
+    check_table_format(args.output_format)
+    if not args.no_hdf5:
+        get_hdf5_compression(args.hdf5_compression)
+    if args.xla and not args.compiled_inference:
+        raise ValueError("--xla needs --compiled_inference")
+    if args.in_graph_scoring and not args.streaming:
+        raise ValueError("--in_graph_scoring needs --streaming")
+    if args.in_graph_scoring and args.prediction_cache:
+        raise ValueError("--in_graph_scoring cannot be combined with --prediction_cache")
+    if args.per_chrom and args.streaming:
+        raise ValueError("--per_chrom cannot be combined with --streaming")
+    if args.journal and (args.workers > 0 or args.streaming):
+        raise ValueError("--journal cannot be combined with --workers or --streaming")
+
+    if args.intra_op_threads > 0:
+        tf.config.threading.set_intra_op_parallelism_threads(args.intra_op_threads)
+    if args.inter_op_threads > 0:
+        tf.config.threading.set_inter_op_parallelism_threads(args.inter_op_threads)
+
+    if args.shuffled_scores and len(args.shuffled_scores) != len(args.model):
+        raise ValueError("--shuffled_scores needs one file per model")
+    if args.null_bank and len(args.null_bank) != len(args.model):
+        raise ValueError("--null_bank needs one directory per model")
+    if args.build_null_bank and args.shuffled_scores:
+        raise ValueError("--build_null_bank cannot be combined with --shuffled_scores")
+
+    # load the models and variants
+    models = [load_model_wrapper(x) for x in args.model]
+    model = models[0]
+    for other_model in models[1:]:
+        if other_model.input_shape != model.input_shape or other_model.output_shape != model.output_shape:
+            raise ValueError("All models must have the same input and output shapes")
+    model_prefixes = get_model_out_prefixes(args.out_prefix, args.model)
+
+    # the compiled engines replace model.predict, and are traced and warmed up here once
+    if args.compiled_inference:
+        inference_engine_kwargs = dict(batch_size=args.batch_size, lite=args.lite, jit_compile=args.xla)
+        for x in models:
+            compile_inference_engine(x, **inference_engine_kwargs)
+    else:
+        inference_engine_kwargs = None
+
+    if args.workers > 0:
+        sharded_predictor = ShardedPredictor(args.model,
+                                             args.workers,
+                                             intra_op_threads=args.intra_op_threads,
+                                             inter_op_threads=args.inter_op_threads,
+                                             pin_cpus=args.pin_cpus,
+                                             inference_engine_kwargs=inference_engine_kwargs)
+    else:
+        sharded_predictor = None
+    if args.prediction_cache:
+        prediction_cache = PredictionCache(args.prediction_cache, max_size_gb=args.prediction_cache_size)
+    else:
+        prediction_cache = None
+    variants_table = load_variant_table(args.list, args.schema, chrom=args.chrom)
     
     chrom_sizes = pd.read_csv(args.chrom_sizes, header=None, sep='\t', names=['chrom', 'size'])
     chrom_sizes_dict = chrom_sizes.set_index('chrom')['size'].to_dict()
 
-    print("Original variants table shape:", variants_table.shape)
-
     if args.chrom:
-        variants_table = variants_table.loc[variants_table['chr'] == args.chrom]
         print("Chromosome variants table shape:", variants_table.shape)
+    else:
+        print("Original variants table shape:", variants_table.shape)
 
     # infer input length
     if args.lite:
@@ -40,53 +100,67 @@ def main():
 
     print("Input length inferred from the model:", input_len)
 
-    variants_table = variants_table.loc[variants_table.apply(lambda x: get_valid_variants(x.chr, x.pos, x.allele1, x.allele2, input_len, chrom_sizes_dict), axis=1)]
+    profile_len = model.output_shape[0][1]
+    if not args.no_hdf5:
+        get_profile_window(profile_len, args.profile_window)
+
+    valid_variants, rejected_variants = get_valid_variants_mask(variants_table, input_len, chrom_sizes_dict)
+    variants_table = variants_table.loc[valid_variants]
     variants_table.reset_index(drop=True, inplace=True)
 
     print("Final variants table shape:", variants_table.shape)
+    print_rejected_counts(rejected_variants)
 
+    # one shuffled table per model: precomputed, from the model's null bank,
+    # or the same shuffled variants of this run for all models
+    null_bank_dirs = args.null_bank if args.null_bank else [get_null_bank_dir(x) for x in args.model]
+    shuf_variants_banked = [False] * len(models)
     if args.shuffled_scores:
-        shuf_variants_table = pd.read_table(args.shuffled_scores)
-        print("Shuffled variants table shape:", shuf_variants_table.shape)
-        shuf_scores_file = args.shuffled_scores
+        shuf_variants_tables = [read_score_table(x) for x in args.shuffled_scores]
+        print("Shuffled variants table shape:", shuf_variants_tables[0].shape)
+        shuf_scores_files = args.shuffled_scores
 
     else:
-        shuf_variants_table = create_shuffle_table(variants_table, args.random_seed, args.total_shuf, args.num_shuf)
-        print("Shuffled variants table shape:", shuf_variants_table.shape)
-        shuf_scores_file = '.'.join([args.out_prefix, "variant_scores.shuffled.tsv"])
-
-    peak_scores_file = '.'.join([args.out_prefix, "peak_scores.tsv"])
-
-    if len(shuf_variants_table) > 0:
-        if args.debug_mode:
-            shuf_variants_table = shuf_variants_table.sample(10000, random_state=args.random_seed, ignore_index=True)
-            print()
-            print(shuf_variants_table.head())
-            print("Debug shuffled variants table shape:", shuf_variants_table.shape)
-            print()
-
-        shuf_variants_done = False
-        if os.path.isfile(shuf_scores_file):
-            shuf_variants_table_loaded = pd.read_table(shuf_scores_file)
-            if shuf_variants_table_loaded['variant_id'].tolist() == shuf_variants_table['variant_id'].tolist():
-                shuf_variants_table = shuf_variants_table_loaded.copy()
-                shuf_variants_done = True
-            
-        if not shuf_variants_done:
-            shuf_variant_ids, shuf_allele1_pred_counts, shuf_allele2_pred_counts, \
-            shuf_allele1_pred_profiles, shuf_allele2_pred_profiles = fetch_variant_predictions(model,
-                                                                                shuf_variants_table,
-                                                                                input_len,
-                                                                                args.genome,
-                                                                                args.batch_size,
-                                                                                debug_mode=args.debug_mode,
-                                                                                lite=args.lite,
-                                                                                shuf=True,
-                                                                                forward_only=args.forward_only)
-            assert np.array_equal(shuf_variants_table["variant_id"].tolist(), shuf_variant_ids)
-            shuf_variants_table["allele1_pred_counts"] = shuf_allele1_pred_counts
-            shuf_variants_table["allele2_pred_counts"] = shuf_allele2_pred_counts
-
+        null_bank_provenances = [get_null_bank_provenance(x, args) for x in args.model]
+        shuf_variants_tables = [None] * len(models)
+        if not (args.no_null_bank or args.build_null_bank):
+            shuf_variants_tables = [load_null_bank(x, y) for x, y in zip(null_bank_dirs, null_bank_provenances)]
+        shuf_variants_banked = [x is not None for x in shuf_variants_tables]
+        shuf_scores_files = [os.path.join(x, NULL_BANK_SCORES) if banked else get_table_file('.'.join([y, "variant_scores.shuffled"]), args.output_format)
+                             for x, y, banked in zip(null_bank_dirs, model_prefixes, shuf_variants_banked)]
+
+        if not all(shuf_variants_banked):
+            if args.build_null_bank and args.null_bank_size:
+                shuf_variants_table = create_shuffle_table(variants_table, args.random_seed, args.null_bank_size, args.num_shuf)
+            else:
+                shuf_variants_table = create_shuffle_table(variants_table, args.random_seed, args.total_shuf, args.num_shuf)
+            print("Shuffled variants table shape:", shuf_variants_table.shape)
+            for i in range(len(models)):
+                if not shuf_variants_banked[i]:
+                    shuf_variants_tables[i] = shuf_variants_table if i == shuf_variants_banked.index(False) else shuf_variants_table.copy()
+
+    peak_scores_files = [get_table_file('.'.join([x, "peak_scores"]), args.output_format) for x in model_prefixes]
+
+    # the shuffled scores are rescored from a journal left by an interrupted run, which keeps their exact values
+    shuf_journaled = args.journal and os.path.isfile('.'.join([args.out_prefix, 'shuffled', 'journal']))
+    shuf_variants_done = [True] * len(models)
+    for i in range(len(models)):
+        if len(shuf_variants_tables[i]) > 0 and not shuf_variants_banked[i]:
+            if args.debug_mode:
+                shuf_variants_tables[i] = shuf_variants_tables[i].sample(10000, random_state=args.random_seed, ignore_index=True)
+                print()
+                print(shuf_variants_tables[i].head())
+                print("Debug shuffled variants table shape:", shuf_variants_tables[i].shape)
+                print()
+
+            shuf_variants_done[i] = False
+            if os.path.isfile(shuf_scores_files[i]) and not shuf_journaled:
+                shuf_variants_table_loaded = read_score_table(shuf_scores_files[i])
+                if shuf_variants_table_loaded['variant_id'].tolist() == shuf_variants_tables[i]['variant_id'].tolist():
+                    shuf_variants_tables[i] = shuf_variants_table_loaded.copy()
+                    shuf_variants_done[i] = True
+
+    peak_pred_counts = [None] * len(models)
     if args.peaks:
         if args.peak_chrom_sizes == None:
             args.peak_chrom_sizes = args.chrom_sizes
@@ -104,10 +178,12 @@ def main():
 
         peaks.sort_values(by=['chr', 'start', 'end', 'summit', 'rank'], ascending=[True, True, True, True, False], inplace=True)
         peaks.drop_duplicates(subset=['chr', 'start', 'end', 'summit'], inplace=True)
-        peaks = peaks.loc[peaks.apply(lambda x: get_valid_peaks(x.chr, x.start, x.summit, input_len, peak_chrom_sizes_dict), axis=1)]
+        valid_peaks, rejected_peaks = get_valid_peaks_mask(peaks, input_len, peak_chrom_sizes_dict)
+        peaks = peaks.loc[valid_peaks]
         peaks.reset_index(drop=True, inplace=True)
 
         print("De-duplicated peak table shape:", peaks.shape)
+        print_rejected_counts(rejected_peaks)
 
         if args.debug_mode:
             peaks = peaks.sample(10000, random_state=args.random_seed, ignore_index=True)
@@ -121,108 +197,131 @@ def main():
                 peaks = peaks.sample(args.max_peaks, random_state=args.random_seed, ignore_index=True)
                 print("Subsampled peak table shape:", peaks.shape)
 
-        peak_scores_done = False
-        if os.path.isfile(peak_scores_file):
-            peaks_loaded = pd.read_table(peak_scores_file)
-            if peaks_loaded['peak_id'].tolist() == peaks['peak_id'].tolist():
-                peaks = peaks_loaded.copy()
-                peak_scores_done = True
+        peak_tables = [peaks] + [peaks.copy() for x in models[1:]]
+        peak_scores_todo = []
+        for i in range(len(models)):
+            if os.path.isfile(peak_scores_files[i]):
+                peaks_loaded = read_score_table(peak_scores_files[i], dtype={"peak_score": np.float32}, float_precision="round_trip")
+                if peaks_loaded['peak_id'].tolist() == peaks['peak_id'].tolist():
+                    peak_tables[i] = peaks_loaded.copy()
+                    continue
+            peak_scores_todo.append(i)
             
-        if not peak_scores_done:
-            peak_ids, peak_pred_counts, peak_pred_profiles = fetch_peak_predictions(model,
+        if peak_scores_todo:
+            todo_sharded_predictor = None if sharded_predictor is None else sharded_predictor.for_models(peak_scores_todo)
+            peak_ids, todo_peak_pred_counts, todo_peak_pred_profiles = fetch_peak_predictions([models[i] for i in peak_scores_todo],
                                                                 peaks,
                                                                 input_len,
                                                                 args.peak_genome,
                                                                 args.batch_size,
                                                                 debug_mode=args.debug_mode,
                                                                 lite=args.lite,
-                                                                forward_only=args.forward_only)
+                                                                forward_only=args.forward_only,
+                                                                num_workers=args.prefetch_workers,
+                                                                queue_depth=args.queue_depth,
+                                                                use_processes=args.prefetch_processes,
+                                                                fused=args.fused_inference,
+                                                                profile_dtype=args.profile_dtype,
+                                                                sharded_predictor=todo_sharded_predictor,
+                                                                prediction_cache=prediction_cache,
+                                                                journal_prefix='.'.join([args.out_prefix, 'peaks']) if args.journal else None)
             assert np.array_equal(peaks["peak_id"].tolist(), peak_ids)
-            peaks["peak_score"] = peak_pred_counts
-            print()
-            print(peaks.head())
-            print("Peak score table shape:", peaks.shape)
-            print()
-            peaks.to_csv(peak_scores_file, sep="\t", index=False)
-
-        if len(shuf_variants_table) > 0 and not shuf_variants_done:
-            shuf_logfc, shuf_jsd, \
-            shuf_allele1_quantile, shuf_allele2_quantile = get_variant_scores_with_peaks(shuf_allele1_pred_counts,
-                                                                                            shuf_allele2_pred_counts,
-                                                                                            shuf_allele1_pred_profiles,
-                                                                                            shuf_allele2_pred_profiles,
-                                                                                            np.array(peaks["peak_score"].tolist()))
-            shuf_indel_idx, shuf_adjusted_jsd_list = adjust_indel_jsd(shuf_variants_table,
-                                                                      shuf_allele1_pred_profiles,
-                                                                      shuf_allele2_pred_profiles,
-                                                                      shuf_jsd)
-            shuf_has_indel_variants = (len(shuf_indel_idx) > 0)
-            
-            shuf_variants_table["logfc"] = shuf_logfc
-            shuf_variants_table["abs_logfc"] = np.abs(shuf_logfc)
-            if shuf_has_indel_variants:
-                shuf_variants_table["jsd"] = shuf_adjusted_jsd_list
-            else:
-                shuf_variants_table["jsd"] = shuf_jsd
-                assert np.array_equal(shuf_adjusted_jsd_list, shuf_jsd)
-            shuf_variants_table['original_jsd'] = shuf_jsd
-            shuf_variants_table["logfc_x_jsd"] =  shuf_variants_table["logfc"] * shuf_variants_table["jsd"]
-            shuf_variants_table["abs_logfc_x_jsd"] = shuf_variants_table["abs_logfc"] * shuf_variants_table["jsd"]
-
-            shuf_variants_table["allele1_quantile"] = shuf_allele1_quantile
-            shuf_variants_table["allele2_quantile"] = shuf_allele2_quantile
-            shuf_variants_table["active_allele_quantile"] = shuf_variants_table[["allele1_quantile", "allele2_quantile"]].max(axis=1)
-            shuf_variants_table["quantile_change"] = shuf_variants_table["allele2_quantile"] - shuf_variants_table["allele1_quantile"]
-            shuf_variants_table["abs_quantile_change"] = np.abs(shuf_variants_table["quantile_change"])
-            shuf_variants_table["logfc_x_active_allele_quantile"] = shuf_variants_table["logfc"] * shuf_variants_table["active_allele_quantile"]
-            shuf_variants_table["abs_logfc_x_active_allele_quantile"] = shuf_variants_table["abs_logfc"] * shuf_variants_table["active_allele_quantile"]
-            shuf_variants_table["jsd_x_active_allele_quantile"] = shuf_variants_table["jsd"] * shuf_variants_table["active_allele_quantile"]
-            shuf_variants_table["logfc_x_jsd_x_active_allele_quantile"] = shuf_variants_table["logfc_x_jsd"] * shuf_variants_table["active_allele_quantile"]
-            shuf_variants_table["abs_logfc_x_jsd_x_active_allele_quantile"] = shuf_variants_table["abs_logfc_x_jsd"] * shuf_variants_table["active_allele_quantile"]
-
-            assert shuf_variants_table["abs_logfc"].shape == shuf_logfc.shape
-            assert shuf_variants_table["abs_logfc"].shape == shuf_jsd.shape
-            assert shuf_variants_table["abs_logfc"].shape == shuf_variants_table["abs_logfc_x_jsd"].shape
-
-            print()
-            print(shuf_variants_table.head())
-            print("Shuffled score table shape:", shuf_variants_table.shape)
-            print()
-            shuf_variants_table.to_csv(shuf_scores_file, sep="\t", index=False)
-
-    else:
-        if len(shuf_variants_table) > 0 and not shuf_variants_done:
-            shuf_logfc, shuf_jsd = get_variant_scores(shuf_allele1_pred_counts,
-                                                    shuf_allele2_pred_counts,
-                                                    shuf_allele1_pred_profiles,
-                                                    shuf_allele2_pred_profiles)
-            
-            shuf_indel_idx, shuf_adjusted_jsd_list = adjust_indel_jsd(shuf_variants_table,
-                                                                      shuf_allele1_pred_profiles,
-                                                                      shuf_allele2_pred_profiles,
-                                                                      shuf_jsd)
-            shuf_has_indel_variants = (len(shuf_indel_idx) > 0)
-            
-            shuf_variants_table["logfc"] = shuf_logfc
-            shuf_variants_table["abs_logfc"] = np.abs(shuf_logfc)
-            if shuf_has_indel_variants:
-                shuf_variants_table["jsd"] = shuf_adjusted_jsd_list
-            else:
-                shuf_variants_table["jsd"] = shuf_jsd
-                assert np.array_equal(shuf_adjusted_jsd_list, shuf_jsd)
-            shuf_variants_table['original_jsd'] = shuf_jsd
-            shuf_variants_table["logfc_x_jsd"] =  shuf_variants_table["logfc"] * shuf_variants_table["jsd"]
-            shuf_variants_table["abs_logfc_x_jsd"] = shuf_variants_table["abs_logfc"] * shuf_variants_table["jsd"]
-
-            assert shuf_variants_table["abs_logfc"].shape == shuf_logfc.shape
-            assert shuf_variants_table["abs_logfc"].shape == shuf_jsd.shape
-            assert shuf_variants_table["abs_logfc"].shape == shuf_variants_table["abs_logfc_x_jsd"].shape
-
-            print()
-            print(shuf_variants_table.head())
-            print("Shuffled score table shape:", shuf_variants_table.shape)
-            print()
-            shuf_variants_table.to_csv(shuf_scores_file, sep="\t", index=False)
+            for i, counts in zip(peak_scores_todo, todo_peak_pred_counts):
+                peak_tables[i]["peak_score"] = counts
+                print()
+                print(peak_tables[i].head())
+                print("Peak score table shape:", peak_tables[i].shape)
+                print()
+                write_score_table(peak_tables[i], peak_scores_files[i])
+
+        peak_pred_counts = [np.array(x["peak_score"].tolist()) for x in peak_tables]
+
+    shuf_scores_todo = [i for i in range(len(models)) if not shuf_variants_done[i]]
+    if shuf_scores_todo:
+        # the models still to score share a single pass over the same shuffled variants
+        shuf_variants_table = shuf_variants_tables[shuf_scores_todo[0]]
+        for i in shuf_scores_todo[1:]:
+            assert shuf_variants_tables[i]['variant_id'].tolist() == shuf_variants_table['variant_id'].tolist()
+
+        if args.streaming:
+            # score and write out the shuffled variants one batch at a time,
+            # keeping only the scalar scores needed for the p-values
+            shuf_score_batches = {i: [] for i in shuf_scores_todo}
+            shuf_score_writers = {i: ScoreTableWriter(shuf_scores_files[i]) for i in shuf_scores_todo}
+            for batch_start, batch_variant_ids, batch_allele1_pred_counts, batch_allele2_pred_counts, \
+                batch_allele1_pred_profiles, batch_allele2_pred_profiles in iter_variant_predictions([models[i] for i in shuf_scores_todo],
+                                                                                    shuf_variants_table,
+                                                                                    input_len,
+                                                                                    args.genome,
+                                                                                    args.batch_size,
+                                                                                    lite=args.lite,
+                                                                                    shuf=True,
+                                                                                    forward_only=args.forward_only,
+                                                                                    num_workers=args.prefetch_workers,
+                                                                                    queue_depth=args.queue_depth,
+                                                                                    use_processes=args.prefetch_processes,
+                                                                                    fused=args.fused_inference,
+                                                                                    profile_dtype=args.profile_dtype,
+                                                                                    prediction_cache=prediction_cache):
+                for j, i in enumerate(shuf_scores_todo):
+                    shuf_batch_table = shuf_variants_table.iloc[batch_start:batch_start + len(batch_variant_ids)].reset_index(drop=True)
+                    assert np.array_equal(shuf_batch_table["variant_id"].tolist(), batch_variant_ids)
+                    shuf_batch_table = score_variants(shuf_batch_table,
+                                                      batch_allele1_pred_counts[j],
+                                                      batch_allele2_pred_counts[j],
+                                                      batch_allele1_pred_profiles[j],
+                                                      batch_allele2_pred_profiles[j],
+                                                      peak_pred_counts=peak_pred_counts[i])
+                    shuf_score_writers[i].write(shuf_batch_table)
+                    shuf_score_batches[i].append(shuf_batch_table)
+
+            for i in shuf_scores_todo:
+                shuf_score_writers[i].close()
+                shuf_variants_tables[i] = pd.concat(shuf_score_batches[i], ignore_index=True)
+                print()
+                print(shuf_variants_tables[i].head())
+                print("Shuffled score table shape:", shuf_variants_tables[i].shape)
+                print()
+
+        else:
+            todo_sharded_predictor = None if sharded_predictor is None else sharded_predictor.for_models(shuf_scores_todo)
+            shuf_variant_ids, shuf_allele1_pred_counts, shuf_allele2_pred_counts, \
+            shuf_allele1_pred_profiles, shuf_allele2_pred_profiles = fetch_variant_predictions([models[i] for i in shuf_scores_todo],
+                                                                                shuf_variants_table,
+                                                                                input_len,
+                                                                                args.genome,
+                                                                                args.batch_size,
+                                                                                debug_mode=args.debug_mode,
+                                                                                lite=args.lite,
+                                                                                shuf=True,
+                                                                                forward_only=args.forward_only,
+                                                                                num_workers=args.prefetch_workers,
+                                                                                queue_depth=args.queue_depth,
+                                                                                use_processes=args.prefetch_processes,
+                                                                                fused=args.fused_inference,
+                                                                                profile_dtype=args.profile_dtype,
+                                                                                sharded_predictor=todo_sharded_predictor,
+                                                                                prediction_cache=prediction_cache,
+                                                                                journal_prefix='.'.join([args.out_prefix, 'shuffled']) if args.journal else None)
+            assert np.array_equal(shuf_variants_table["variant_id"].tolist(), shuf_variant_ids)
+            for j, i in enumerate(shuf_scores_todo):
+                shuf_variants_tables[i] = score_variants(shuf_variants_tables[i],
+                                                         shuf_allele1_pred_counts[j],
+                                                         shuf_allele2_pred_counts[j],
+                                                         shuf_allele1_pred_profiles[j],
+                                                         shuf_allele2_pred_profiles[j],
+                                                         peak_pred_counts=peak_pred_counts[i])
+
+                print()
+                print(shuf_variants_tables[i].head())
+                print("Shuffled score table shape:", shuf_variants_tables[i].shape)
+                print()
+                write_score_table(shuf_variants_tables[i], shuf_scores_files[i])
+
+    if args.build_null_bank:
+        for i in range(len(models)):
+            write_null_bank(null_bank_dirs[i], shuf_variants_tables[i], null_bank_provenances[i],
+                            args.null_bank_size if args.null_bank_size else len(shuf_variants_tables[i]))
 
     if args.debug_mode:
         variants_table = variants_table.sample(10000, random_state=args.random_seed, ignore_index=True)
@@ -231,102 +330,282 @@ def main():
         print("Debug variants table shape:", variants_table.shape)
         print()
 
-    # fetch model prediction for variants
-    variant_ids, allele1_pred_counts, allele2_pred_counts, \
-    allele1_pred_profiles, allele2_pred_profiles = fetch_variant_predictions(model,
-                                                                        variants_table,
-                                                                        input_len,
-                                                                        args.genome,
-                                                                        args.batch_size,
-                                                                        debug_mode=args.debug_mode,
-                                                                        lite=args.lite,
-                                                                        shuf=False,
-                                                                        forward_only=args.forward_only)
+    shuf_variants_tables = [None if len(x) == 0 else x for x in shuf_variants_tables]
+    # the shuffled scores are sorted once for the p-values of all the variants
+    null_distributions = [None if x is None else NullDistribution(x, memmap_prefix='.'.join([y, "null"]) if args.null_memmap else None)
+                          for x, y in zip(shuf_variants_tables, model_prefixes)]
+
+    scores_files = [get_table_file('.'.join([x, "variant_scores"]), args.output_format) for x in model_prefixes]
+    predictions_files = ['.'.join([x, "variant_predictions.h5"]) for x in model_prefixes]
+    # with several models, the mean scores across them are written next to the per-model scores
+    mean_scores_file = get_table_file('.'.join([args.out_prefix, "mean.variant_scores"]), args.output_format)
+    id_columns = list(variants_table.columns)
+
+    if args.streaming:
+        # score each batch as soon as it is predicted and append it to the outputs
+        if not args.no_hdf5:
+            prediction_writers = [PredictionWriter(x, variants_table['variant_id'].values, profile_len, args.profile_dtype,
+                                                   args.hdf5_compression, args.batch_size,
+                                                   profile_window=args.profile_window, profile_summary=args.profile_summary)
+                                  for x in predictions_files]
+
+        score_writers = [ScoreTableWriter(x) for x in scores_files]
+        mean_score_writer = ScoreTableWriter(mean_scores_file) if len(models) > 1 else None
+        num_scored = 0
+        if args.in_graph_scoring:
+            # the profiles only leave the graph to be saved, or to adjust the jsd of indels
+            batches = iter_variant_scores(models,
+                                          variants_table,
+                                          input_len,
+                                          args.genome,
+                                          args.batch_size,
+                                          lite=args.lite,
+                                          forward_only=args.forward_only,
+                                          num_workers=args.prefetch_workers,
+                                          queue_depth=args.queue_depth,
+                                          use_processes=args.prefetch_processes,
+                                          profile_dtype=args.profile_dtype,
+                                          return_profiles=not args.no_hdf5 and (args.profile_window != 0 or args.profile_summary))
+        else:
+            batches = ((batch_start, batch_variant_ids, batch_allele1_pred_counts, batch_allele2_pred_counts,
+                        [None] * len(models), [None] * len(models), batch_allele1_pred_profiles, batch_allele2_pred_profiles)
+                       for batch_start, batch_variant_ids, batch_allele1_pred_counts, batch_allele2_pred_counts,
+                           batch_allele1_pred_profiles, batch_allele2_pred_profiles in iter_variant_predictions(models,
+                                                                                variants_table,
+                                                                                input_len,
+                                                                                args.genome,
+                                                                                args.batch_size,
+                                                                                lite=args.lite,
+                                                                                shuf=False,
+                                                                                forward_only=args.forward_only,
+                                                                                num_workers=args.prefetch_workers,
+                                                                                queue_depth=args.queue_depth,
+                                                                                use_processes=args.prefetch_processes,
+                                                                                fused=args.fused_inference,
+                                                                                profile_dtype=args.profile_dtype,
+                                                                                prediction_cache=prediction_cache))
+        for batch_start, batch_variant_ids, batch_allele1_pred_counts, batch_allele2_pred_counts, \
+            batch_logfc, batch_jsd, batch_allele1_pred_profiles, batch_allele2_pred_profiles in batches:
+            batch_end = batch_start + len(batch_variant_ids)
+            batch_tables = []
+            for i in range(len(models)):
+                batch_table = variants_table.iloc[batch_start:batch_end].reset_index(drop=True)
+                assert np.array_equal(batch_table["variant_id"].tolist(), batch_variant_ids)
+                batch_table = score_variants(batch_table,
+                                             batch_allele1_pred_counts[i],
+                                             batch_allele2_pred_counts[i],
+                                             batch_allele1_pred_profiles[i],
+                                             batch_allele2_pred_profiles[i],
+                                             peak_pred_counts=peak_pred_counts[i],
+                                             null_distribution=null_distributions[i],
+                                             logfc=batch_logfc[i],
+                                             jsd=batch_jsd[i])
+                if args.schema == "bed":
+                    batch_table['pos'] = batch_table['pos'] - 1
+
+                if not args.no_hdf5:
+                    prediction_writers[i].write(batch_start,
+                                                batch_allele1_pred_counts[i],
+                                                batch_allele2_pred_counts[i],
+                                                batch_allele1_pred_profiles[i],
+                                                batch_allele2_pred_profiles[i])
+
+                if batch_start == 0:
+                    print()
+                    print(batch_table.head())
+                score_writers[i].write(batch_table)
+                batch_tables.append(batch_table)
+
+            if len(models) > 1:
+                mean_score_writer.write(get_mean_variant_scores(batch_tables, id_columns))
+            num_scored = batch_end
+
+        if not args.no_hdf5:
+            for writer in prediction_writers:
+                writer.close()
+
+        for writer in score_writers + ([mean_score_writer] if len(models) > 1 else []):
+            if num_scored == 0:
+                writer.write(variants_table)
+            writer.close()
+
+        print("Output score table rows:", num_scored)
+        print()
 
-    if args.peaks:
-        logfc, jsd, \
-        allele1_quantile, allele2_quantile = get_variant_scores_with_peaks(allele1_pred_counts,
-                                                                                allele2_pred_counts,
-                                                                                allele1_pred_profiles,
-                                                                                allele2_pred_profiles,
-                                                                                np.array(peaks["peak_score"].tolist()))
+    elif args.per_chrom:
+        # score the chromosomes separately, largest first, into per-chromosome
+        # files that are then merged into the outputs sorted by position
+        chrom_ranks = get_chrom_ranks(chrom_sizes_dict)
+        chroms = get_largest_first_chroms(variants_table, chrom_ranks)
+        chrom_scores_files = [[get_table_file('.'.join([x, str(chrom), "variant_scores"]), args.output_format) for chrom in chroms] for x in model_prefixes]
+        chrom_predictions_files = [['.'.join([x, str(chrom), "variant_predictions.h5"]) for chrom in chroms] for x in model_prefixes]
+        chrom_mean_scores_files = [get_table_file('.'.join([args.out_prefix, str(chrom), "mean.variant_scores"]), args.output_format) for chrom in chroms]
+
+        chrom_tables = []
+        todo_chroms = []
+        for j, chrom in enumerate(chroms):
+            chrom_variants_table = variants_table.loc[variants_table['chr'] == chrom].sort_values(by='pos', kind='stable')
+            chrom_variants_table.reset_index(drop=True, inplace=True)
+            chrom_tables.append(chrom_variants_table)
+
+            # the per-model scores of a chromosome are written last, once its other outputs are complete
+            chrom_scores_done = True
+            for i in range(len(models)):
+                if not os.path.isfile(chrom_scores_files[i][j]):
+                    chrom_scores_done = False
+                elif read_score_table(chrom_scores_files[i][j], columns=['variant_id'])['variant_id'].tolist() != chrom_variants_table['variant_id'].tolist():
+                    chrom_scores_done = False
+            if not chrom_scores_done:
+                todo_chroms.append(j)
+        print("Chromosomes left to score, largest first:", ', '.join(str(chroms[j]) for j in todo_chroms))
+
+        for k, variant_ids, allele1_pred_counts, allele2_pred_counts, \
+            allele1_pred_profiles, allele2_pred_profiles in iter_table_variant_predictions(models,
+                                                                            [chrom_tables[j] for j in todo_chroms],
+                                                                            input_len,
+                                                                            args.genome,
+                                                                            args.batch_size,
+                                                                            debug_mode=args.debug_mode,
+                                                                            lite=args.lite,
+                                                                            shuf=False,
+                                                                            forward_only=args.forward_only,
+                                                                            num_workers=args.prefetch_workers,
+                                                                            queue_depth=args.queue_depth,
+                                                                            use_processes=args.prefetch_processes,
+                                                                            fused=args.fused_inference,
+                                                                            profile_dtype=args.profile_dtype,
+                                                                            sharded_predictor=sharded_predictor,
+                                                                            prediction_cache=prediction_cache,
+                                                                            journal_prefixes=['.'.join([args.out_prefix, str(chroms[j]), 'observed'])
+                                                                                              for j in todo_chroms] if args.journal else None):
+            j = todo_chroms[k]
+            assert np.array_equal(chrom_tables[j]["variant_id"].tolist(), variant_ids)
+            score_tables = []
+            for i in range(len(models)):
+                score_table = score_variants(chrom_tables[j].copy(),
+                                             allele1_pred_counts[i],
+                                             allele2_pred_counts[i],
+                                             allele1_pred_profiles[i],
+                                             allele2_pred_profiles[i],
+                                             peak_pred_counts=peak_pred_counts[i],
+                                             null_distribution=null_distributions[i])
+
+                if args.schema == "bed":
+                    score_table['pos'] = score_table['pos'] - 1
+
+                if not args.no_hdf5:
+                    writer = PredictionWriter(chrom_predictions_files[i][j], variant_ids, profile_len, args.profile_dtype,
+                                              args.hdf5_compression, args.batch_size,
+                                              profile_window=args.profile_window, profile_summary=args.profile_summary)
+                    writer.write(0, allele1_pred_counts[i], allele2_pred_counts[i], allele1_pred_profiles[i], allele2_pred_profiles[i])
+                    writer.close()
+                score_tables.append(score_table)
+
+            if len(models) > 1:
+                write_score_table(get_mean_variant_scores(score_tables, id_columns), chrom_mean_scores_files[j])
+            print()
+            print(score_tables[0].head())
+            print("Output " + str(chroms[j]) + " score table shape:", score_tables[0].shape)
+            print()
+            for i in range(len(models)):
+                write_score_table(score_tables[i], chrom_scores_files[i][j])
+            if args.journal:
+                remove_journal('.'.join([args.out_prefix, str(chroms[j]), 'observed']))
+
+        # the per-chromosome files are merged in genome order and removed
+        merge_order = sorted(range(len(chroms)), key=lambda j: chrom_ranks.get(str(chroms[j]), len(chrom_ranks)))
+        num_scored = 0
+        for i in range(len(models)):
+            if not chroms:
+                write_score_table(variants_table, scores_files[i])
+                continue
+            num_scored = merge_chrom_scores([chrom_scores_files[i][j] for j in merge_order], scores_files[i], chrom_ranks)
+            if not args.no_hdf5:
+                merge_chrom_predictions([chrom_predictions_files[i][j] for j in merge_order], predictions_files[i],
+                                        compression=args.hdf5_compression, chunk_size=args.batch_size)
+        if len(models) > 1:
+            if chroms:
+                merge_chrom_scores([chrom_mean_scores_files[j] for j in merge_order], mean_scores_file, chrom_ranks)
+            else:
+                write_score_table(variants_table, mean_scores_file)
+
+        for j in range(len(chroms)):
+            for i in range(len(models)):
+                os.remove(chrom_scores_files[i][j])
+                if not args.no_hdf5:
+                    os.remove(chrom_predictions_files[i][j])
+            if len(models) > 1:
+                os.remove(chrom_mean_scores_files[j])
+
+        print("Output score table rows:", num_scored)
+        print()
 
     else:
-        logfc, jsd = get_variant_scores(allele1_pred_counts,
-                                        allele2_pred_counts,
-                                        allele1_pred_profiles,
-                                        allele2_pred_profiles)
-
-    indel_idx, adjusted_jsd_list = adjust_indel_jsd(variants_table,allele1_pred_profiles,allele2_pred_profiles,jsd)
-    has_indel_variants = (len(indel_idx) > 0)
-
-    assert np.array_equal(variants_table["variant_id"].tolist(), variant_ids)
-    variants_table["allele1_pred_counts"] = allele1_pred_counts
-    variants_table["allele2_pred_counts"] = allele2_pred_counts
-    variants_table["logfc"] = logfc
-    variants_table["abs_logfc"] = np.abs(variants_table["logfc"])
-    if has_indel_variants:
-        variants_table["jsd"] = adjusted_jsd_list
-    else:
-        variants_table["jsd"] = jsd
-        assert np.array_equal(adjusted_jsd_list, jsd)
-    variants_table["original_jsd"] = jsd
-    variants_table["logfc_x_jsd"] = variants_table["logfc"] * variants_table["jsd"]
-    variants_table["abs_logfc_x_jsd"] = variants_table["abs_logfc"] * variants_table["jsd"]
-
-    if len(shuf_variants_table) > 0:
-        variants_table["logfc.pval"] = get_pvals(variants_table["logfc"].tolist(), shuf_variants_table["logfc"], tail="both")
-        variants_table["abs_logfc.pval"] = get_pvals(variants_table["abs_logfc"].tolist(), shuf_variants_table["abs_logfc"], tail="right")
-        variants_table["jsd.pval"] = get_pvals(variants_table["jsd"].tolist(), shuf_variants_table["jsd"], tail="right")
-        variants_table["logfc_x_jsd.pval"] = get_pvals(variants_table["logfc_x_jsd"].tolist(), shuf_variants_table["logfc_x_jsd"], tail="both")
-        variants_table["abs_logfc_x_jsd.pval"] = get_pvals(variants_table["abs_logfc_x_jsd"].tolist(), shuf_variants_table["abs_logfc_x_jsd"], tail="right")
-    if args.peaks:
-        variants_table["allele1_quantile"] = allele1_quantile
-        variants_table["allele2_quantile"] = allele2_quantile
-        variants_table["active_allele_quantile"] = variants_table[["allele1_quantile", "allele2_quantile"]].max(axis=1)
-        variants_table["quantile_change"] = variants_table["allele2_quantile"] - variants_table["allele1_quantile"]
-        variants_table["abs_quantile_change"] = np.abs(variants_table["quantile_change"])
-        variants_table["logfc_x_active_allele_quantile"] = variants_table["logfc"] * variants_table["active_allele_quantile"]
-        variants_table["abs_logfc_x_active_allele_quantile"] = variants_table["abs_logfc"] * variants_table["active_allele_quantile"]
-        variants_table["jsd_x_active_allele_quantile"] = variants_table["jsd"] * variants_table["active_allele_quantile"]
-        variants_table["logfc_x_jsd_x_active_allele_quantile"] = variants_table["logfc_x_jsd"] * variants_table["active_allele_quantile"]
-        variants_table["abs_logfc_x_jsd_x_active_allele_quantile"] = variants_table["abs_logfc_x_jsd"] * variants_table["active_allele_quantile"]
-
-        if len(shuf_variants_table) > 0:
-            variants_table["active_allele_quantile.pval"] = get_pvals(variants_table["active_allele_quantile"].tolist(),
-                                                              shuf_variants_table["active_allele_quantile"], tail="right")
-            variants_table['quantile_change.pval'] = get_pvals(variants_table["quantile_change"].tolist(),
-                                                                 shuf_variants_table["quantile_change"], tail="both")
-            variants_table["abs_quantile_change.pval"] = get_pvals(variants_table["abs_quantile_change"].tolist(),
-                                                                     shuf_variants_table["abs_quantile_change"], tail="right")
-            variants_table["logfc_x_active_allele_quantile.pval"] = get_pvals(variants_table["logfc_x_active_allele_quantile"].tolist(),
-                                                                      shuf_variants_table["logfc_x_active_allele_quantile"], tail="both")
-            variants_table["abs_logfc_x_active_allele_quantile.pval"] = get_pvals(variants_table["abs_logfc_x_active_allele_quantile"].tolist(),
-                                                                          shuf_variants_table["abs_logfc_x_active_allele_quantile"], tail="right")
-            variants_table["jsd_x_active_allele_quantile.pval"] = get_pvals(variants_table["jsd_x_active_allele_quantile"].tolist(),
-                                                                    shuf_variants_table["jsd_x_active_allele_quantile"], tail="right")
-            variants_table["logfc_x_jsd_x_active_allele_quantile.pval"] = get_pvals(variants_table["logfc_x_jsd_x_active_allele_quantile"].tolist(),
-                                                                            shuf_variants_table["logfc_x_jsd_x_active_allele_quantile"], tail="both")
-            variants_table["abs_logfc_x_jsd_x_active_allele_quantile.pval"] = get_pvals(variants_table["abs_logfc_x_jsd_x_active_allele_quantile"].tolist(),
-                                                                                shuf_variants_table["abs_logfc_x_jsd_x_active_allele_quantile"], tail="right")
-
-    if args.schema == "bed":
-        variants_table['pos'] = variants_table['pos'] - 1
-
-    # store predictions at variants
-    if not args.no_hdf5:
-        with h5py.File('.'.join([args.out_prefix, "variant_predictions.h5"]), 'w') as f:
-            observed = f.create_group('observed')
-            observed.create_dataset('allele1_pred_counts', data=allele1_pred_counts, compression='gzip', compression_opts=9)
-            observed.create_dataset('allele2_pred_counts', data=allele2_pred_counts, compression='gzip', compression_opts=9)
-            observed.create_dataset('allele1_pred_profiles', data=allele1_pred_profiles, compression='gzip', compression_opts=9)
-            observed.create_dataset('allele2_pred_profiles', data=allele2_pred_profiles, compression='gzip', compression_opts=9)
+        # fetch model predictions for variants
+        variant_ids, allele1_pred_counts, allele2_pred_counts, \
+        allele1_pred_profiles, allele2_pred_profiles = fetch_variant_predictions(models,
+                                                                            variants_table,
+                                                                            input_len,
+                                                                            args.genome,
+                                                                            args.batch_size,
+                                                                            debug_mode=args.debug_mode,
+                                                                            lite=args.lite,
+                                                                            shuf=False,
+                                                                            forward_only=args.forward_only,
+                                                                            num_workers=args.prefetch_workers,
+                                                                            queue_depth=args.queue_depth,
+                                                                            use_processes=args.prefetch_processes,
+                                                                            fused=args.fused_inference,
+                                                                            profile_dtype=args.profile_dtype,
+                                                                            sharded_predictor=sharded_predictor,
+                                                                            prediction_cache=prediction_cache,
+                                                                            journal_prefix='.'.join([args.out_prefix, 'observed']) if args.journal else None)
+
+        assert np.array_equal(variants_table["variant_id"].tolist(), variant_ids)
+        score_tables = []
+        for i in range(len(models)):
+            score_table = score_variants(variants_table if len(models) == 1 else variants_table.copy(),
+                                         allele1_pred_counts[i],
+                                         allele2_pred_counts[i],
+                                         allele1_pred_profiles[i],
+                                         allele2_pred_profiles[i],
+                                         peak_pred_counts=peak_pred_counts[i],
+                                         null_distribution=null_distributions[i])
+
+            if args.schema == "bed":
+                score_table['pos'] = score_table['pos'] - 1
+
+            # store predictions at variants
+            if not args.no_hdf5:
+                writer = PredictionWriter(predictions_files[i], variant_ids, profile_len, args.profile_dtype,
+                                          args.hdf5_compression, args.batch_size,
+                                          profile_window=args.profile_window, profile_summary=args.profile_summary)
+                writer.write(0, allele1_pred_counts[i], allele2_pred_counts[i], allele1_pred_profiles[i], allele2_pred_profiles[i])
+                writer.close()
 
-    print()
-    print(variants_table.head())
-    print("Output score table shape:", variants_table.shape)
-    print()
-    variants_table.to_csv('.'.join([args.out_prefix, "variant_scores.tsv"]), sep="\t", index=False)
+            print()
+            print(score_table.head())
+            print("Output score table shape:", score_table.shape)
+            print()
+            write_score_table(score_table, scores_files[i])
+            score_tables.append(score_table)
+
+        if len(models) > 1:
+            mean_scores = get_mean_variant_scores(score_tables, id_columns)
+            print()
+            print(mean_scores.head())
+            print("Mean score table shape:", mean_scores.shape)
+            print()
+            write_score_table(mean_scores, mean_scores_file)
+
+    if sharded_predictor is not None:
+        sharded_predictor.shutdown()
+    if prediction_cache is not None:
+        prediction_cache.close()
+    # the journals are only needed until the outputs are written
+    if args.journal:
+        for stage in ['peaks', 'shuffled', 'observed']:
+            remove_journal('.'.join([args.out_prefix, stage]))
 
     print("DONE")
     print()
@@ -32,7 +32,6 @@ def main():
 
     model = load_model_wrapper(args.model)
     variants_table = load_variant_table(args.list, args.schema)
-    variants_table = variants_table.fillna('-')
 
     chrom_sizes = pd.read_csv(args.chrom_sizes, header=None, sep='\t', names=['chrom', 'size'])
     chrom_sizes_dict = chrom_sizes.set_index('chrom')['size'].to_dict()
@@ -49,9 +48,11 @@ def main():
     print("input length inferred from the model: ", input_len)
 
     print(variants_table.shape)
-    variants_table = variants_table.loc[variants_table.apply(lambda x: get_valid_variants(x.chr, x.pos, x.allele1, x.allele2, input_len, chrom_sizes_dict), axis=1)]
+    valid_variants, rejected_variants = get_valid_variants_mask(variants_table, input_len, chrom_sizes_dict)
+    variants_table = variants_table.loc[valid_variants]
     variants_table.reset_index(drop=True, inplace=True)
     print(variants_table.shape)
+    print_rejected_counts(rejected_variants)
     
     for shap_type in args.shap_type:
         # fetch model prediction for variants
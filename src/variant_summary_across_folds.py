@@ -3,6 +3,7 @@ import numpy as np
 import os
 from utils.argmanager import *
 from utils.helpers import *
+from utils.table_io import *
 
 
 def main():
@@ -12,41 +13,28 @@ def main():
     variant_table_list = args.score_list
     output_prefix = args.out_prefix
 
+    check_table_format(args.output_format)
+    id_columns = get_variant_schema(args.schema)
+
     score_dict = {}
     for i in range(len(variant_table_list)):
         variant_score_file = os.path.join(variant_score_dir, variant_table_list[i])
         assert os.path.isfile(variant_score_file)
-        var_score = pd.read_table(variant_score_file)
+        # only the variant ids, the scores and their p-values are loaded
+        columns = [x for x in get_table_columns(variant_score_file)
+                   if x in id_columns or x in MEAN_SCORES or (x[-5:] in ['.pval', '_pval'] and x[:-5] in MEAN_SCORES)]
+        var_score = read_score_table(variant_score_file, columns=columns)
         score_dict[i] = var_score
 
-    variant_scores = score_dict[0][get_variant_schema(args.schema)].copy()
-    for i in score_dict:
-        assert score_dict[i]['chr'].tolist() == variant_scores['chr'].tolist()
-        assert score_dict[i]['pos'].tolist() == variant_scores['pos'].tolist()
-        assert score_dict[i]['allele1'].tolist() == variant_scores['allele1'].tolist()
-        assert score_dict[i]['allele2'].tolist() == variant_scores['allele2'].tolist()
-        assert score_dict[i]['variant_id'].tolist() == variant_scores['variant_id'].tolist()
-
-    for score in ["logfc", "abs_logfc", "jsd", "logfc_x_jsd", "abs_logfc_x_jsd", "active_allele_quantile",
-                  "logfc_x_active_allele_quantile", "abs_logfc_x_active_allele_quantile", "jsd_x_active_allele_quantile",
-                  "logfc_x_jsd_x_active_allele_quantile", "abs_logfc_x_jsd_x_active_allele_quantile"]:
-        if score in score_dict[0]:
-            variant_scores.loc[:, (score + '.mean')] = np.mean(np.array([score_dict[fold][score].tolist()
-                                                                    for fold in score_dict]), axis=0)
-            if score + '.pval' in score_dict[0]:
-                variant_scores.loc[:, (score + '.mean' + '.pval')] = geo_mean_overflow([score_dict[fold][score + '.pval'].values for fold in score_dict])
-            elif score + '_pval' in score_dict[0]:
-                variant_scores.loc[:, (score + '.mean' + '.pval')] = geo_mean_overflow([score_dict[fold][score + '_pval'].values for fold in score_dict])
+    variant_scores = get_mean_variant_scores([score_dict[i] for i in score_dict], id_columns)
 
     print()
     print(variant_scores.head())
     print("Summary score table shape:", variant_scores.shape)
     print()
 
-    out_file = output_prefix + ".mean.variant_scores.tsv"
-    variant_scores.to_csv(out_file,\
-                          sep="\t",\
-                          index=False)
+    out_file = get_table_file(output_prefix + ".mean.variant_scores", args.output_format)
+    write_score_table(variant_scores, out_file)
 
     print("DONE")
     print()
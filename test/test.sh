@@ -8,6 +8,9 @@ set -x
 # rm -rf output
 mkdir -p output/
 
+# jensenshannon_distance against scipy
+python test_jsd_equivalence.py
+
 python -u ../src/variant_scoring.py \
   -l /oak/stanford/groups/akundaje/airanman/test_data/variant-scorer/shared/encode_variants.subset.tsv \
   -g /oak/stanford/groups/akundaje/airanman/test_data/variant-scorer/shared/GRCh38_no_alt_analysis_set_GCA_000001405.15.fasta \
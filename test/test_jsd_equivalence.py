@@ -0,0 +1,44 @@
+import os
+import sys
+import numpy as np
+from scipy.spatial.distance import jensenshannon
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from utils.helpers import softmax, jensenshannon_distance
+
+
+def scipy_jsd(logits1, logits2):
+    # the per-variant scipy distance on float64 softmax profiles that jensenshannon_distance replaces
+    return np.array([jensenshannon(x, y, base=2.0) for x, y in zip(softmax(logits1.astype(np.float64)),
+                                                                    softmax(logits2.astype(np.float64)))])
+
+def test_jsd_equivalence(num_rows=512, profile_len=1000, random_seed=1234):
+    # allele pairs with effects ranging from none to strong
+    rng = np.random.RandomState(random_seed)
+    allele1_logits = rng.normal(scale=2, size=(num_rows, profile_len)).astype(np.float32)
+    effect_sizes = np.logspace(-6, 1, num_rows, dtype=np.float32)[:, None]
+    allele2_logits = allele1_logits + effect_sizes * rng.normal(size=allele1_logits.shape).astype(np.float32)
+
+    jsd = jensenshannon_distance(allele2_logits, allele1_logits)
+    expected = scipy_jsd(allele2_logits, allele1_logits)
+    np.testing.assert_allclose(jsd, expected, rtol=1e-3, atol=1e-6)
+
+def test_jsd_near_identical(num_rows=256, profile_len=1000, random_seed=1234):
+    # near-identical profiles, where rounding can take scipy's divergence below zero and its distance to NaN,
+    # must give a distance of ~0 instead
+    rng = np.random.RandomState(random_seed)
+    allele1_logits = rng.normal(scale=2, size=(num_rows, profile_len)).astype(np.float32)
+    allele2_logits = allele1_logits.copy()
+    allele2_logits[num_rows // 2:] += np.float32(1e-9) * rng.normal(size=(num_rows - num_rows // 2, profile_len)).astype(np.float32)
+
+    jsd = jensenshannon_distance(allele2_logits, allele1_logits)
+    expected = scipy_jsd(allele2_logits, allele1_logits)
+    assert not np.any(np.isnan(jsd))
+    assert np.any(np.isnan(expected))
+    np.testing.assert_allclose(jsd, np.nan_to_num(expected, nan=0.0), rtol=1e-3, atol=1e-6)
+
+
+if __name__ == "__main__":
+    test_jsd_equivalence()
+    test_jsd_near_identical()
+    print("jensenshannon_distance matches scipy")